@@ -1,49 +1,46 @@
 from datetime import datetime, timedelta
-import pandas as pd
-from sklearn.ensemble import RandomForestRegressor
 import uuid
+from service_state import bump_data_version
+from interaction_snapshot import load_interactions
+
+# Rows per bulk insert into `status`
+STATS_INSERT_BATCH = 500
 
 class AnalyticsSystem:
     def __init__(self, database_client):
         self.database = database_client
         
     def calculate_visitor_stats(self):
-        events = self.database.table('event_participants').select('*').execute()
-        projects = self.database.table('project_members').select('*').execute()
-        videos = self.database.table('video_interactions').select('*').execute()
+        # Reads the interaction snapshot shared with the recommendation run instead of
+        # downloading the three tables again, and counts per entity in one pass over the codes
+        interactions = load_interactions(self.database)
         
         entity_stats = {
-            'event': {},
-            'project': {},
-            'video': {}
+            'event': interactions['event_participants'].entity_counts(),
+            'project': interactions['project_members'].entity_counts(),
+            'video': interactions['video_interactions'].entity_counts()
         }
-        
-        for participant in events.data:
-            entity_id = participant['event_id']
-            entity_stats['event'][entity_id] = entity_stats['event'].get(entity_id, 0) + 1
-                
-        for member in projects.data:
-            entity_id = member['project_id']
-            entity_stats['project'][entity_id] = entity_stats['project'].get(entity_id, 0) + 1
-                
-        for interaction in videos.data:
-            entity_id = interaction['video_id']
-            entity_stats['video'][entity_id] = entity_stats['video'].get(entity_id, 0) + 1
                 
         for entity_type, stats in entity_stats.items():
             self.save_stats(stats, entity_type)
+            
+        bump_data_version('analytics')
         
     def save_stats(self, stats, entity_type):
         today = datetime.now().date()
-        
-        for entity_id, count in stats.items():
-            self.database.table('status').insert({
+        rows = [
+            {
                 'id': str(uuid.uuid4()),
                 'entity_type': entity_type,
                 'entity_id': entity_id,
                 'visitor_count': count,
                 'date': today.isoformat()
-            }).execute()
+            }
+            for entity_id, count in stats.items()
+        ]
+        
+        for start in range(0, len(rows), STATS_INSERT_BATCH):
+            self.database.table('status').insert(rows[start:start + STATS_INSERT_BATCH]).execute()
             
     def predict_future_engagement(self, entity_type, entity_id, days=7):
         historical_data = self.database.table('status').select('*')\
@@ -54,9 +51,16 @@ class AnalyticsSystem:
         if not historical_data.data or len(historical_data.data) < 3:
             return []
             
+        # pandas and sklearn are imported lazily to keep API start-up fast
+        import pandas as pd
+        from sklearn.ensemble import RandomForestRegressor
+        
         df = pd.DataFrame(historical_data.data)
         df['date'] = pd.to_datetime(df['date'])
-        df = df.sort_values('date')
+        # Ingestion writes several delta rows per day, one per flush and worker
+        df = df.groupby('date', as_index=False)['visitor_count'].sum().sort_values('date')
+        if len(df) < 3:
+            return []
         
         X = pd.DataFrame({
             'dayofweek': df['date'].dt.dayofweek,
@@ -98,6 +102,7 @@ class AnalyticsSystem:
         if not recent_stats.data:
             return []
             
+        import pandas as pd
         df = pd.DataFrame(recent_stats.data)
         entity_totals = df.groupby('entity_id')['visitor_count'].sum().reset_index()
         trending = entity_totals.sort_values('visitor_count', ascending=False).head(limit)
@@ -1,12 +1,17 @@
+import service_state
+from service_state import data_version
+from response_cache import ResponseCache
+from snapshot import SnapshotReader, SNAPSHOT_TOP_K
+from suggestion_runs import published_run_id
+from ingestion import InteractionCounters, INGESTION_ENABLED, INGESTION_MAX_EVENT_COUNT, ENTITY_TYPES as INGESTED_ENTITY_TYPES
 from fastapi import FastAPI, HTTPException, Request, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from supabase import create_client
 import os
+import json
 from dotenv import load_dotenv
 from datetime import datetime
-from recommendation_system import ContentRecommender
-from analytics_system import AnalyticsSystem
 import httpx
 import threading
 from slowapi import Limiter
@@ -14,7 +19,7 @@ from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 from slowapi.middleware import SlowAPIMiddleware
 from typing import List, Dict, Any, Optional
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 load_dotenv()
 
@@ -26,7 +31,20 @@ VERIFYING_API = os.getenv('VERIFYING_API')
 if not SUPABASE_URL or not SUPABASE_KEY:
     raise ValueError("Missing required environment variables SUPABASE_URL and/or SUPABASE_KEY")
 
+ENTITY_TYPES = ['videos', 'events', 'projects']
+BATCH_MAX_USERS = int(os.getenv('BATCH_MAX_USERS', '5000'))
+# Users per suggestions query, keeps the in.(...) filter well inside URL length limits
+BATCH_CHUNK_SIZE = 200
+# PostgREST caps the rows returned per request
+QUERY_PAGE_SIZE = 1000
+
+# Probes must answer even when the verifying service is down
+UNVERIFIED_PATHS = {'/health/live', '/health/ready'}
+
 app = FastAPI(title="Content Recommendation API")
+response_cache = ResponseCache()
+snapshots = SnapshotReader()
+interaction_counters = InteractionCounters()
 limiter = Limiter(key_func=get_remote_address)
 app.state.limiter = limiter
 app.add_middleware(SlowAPIMiddleware)
@@ -60,7 +78,7 @@ async def verify_request(request: Request):
 
 @app.middleware("http")
 async def verify_middleware(request: Request, call_next):
-    if not await verify_request(request):
+    if request.url.path not in UNVERIFIED_PATHS and not await verify_request(request):
         return JSONResponse(
             status_code=404,
             content={"detail": "Not found"}
@@ -71,14 +89,52 @@ async def verify_middleware(request: Request, call_next):
 def get_db():
     return create_client(SUPABASE_URL, SUPABASE_KEY)
 
-# Recommendation system
+# Run id of the last published batch, refreshed whenever a new model version lands
+published_runs = {}
+
+def visible_run_id(db):
+    version = data_version('model')
+    if version not in published_runs:
+        published_runs.clear()
+        published_runs[version] = published_run_id(db)
+    return published_runs[version]
+
+# Unexpired suggestions from the published run only, never from a run still being written
+def visible_suggestions(db):
+    query = db.table('suggestions').select('*').gt('expires_at', datetime.now().isoformat())
+    run_id = visible_run_id(db)
+    return query.eq('run_id', run_id) if run_id else query
+
+# Recommendation system, built only when a request falls through to live scoring so the
+# snapshot path never imports torch. It attaches to the shared snapshot so live scoring
+# reads the published model tables.
 def get_recommender(db=Depends(get_db)):
-    return ContentRecommender(db)
+    def build_recommender():
+        from recommendation_system import ContentRecommender
+        recommender = ContentRecommender(db)
+        snapshot = snapshots.current()
+        if snapshot:
+            recommender.attach_snapshot(snapshot)
+        return recommender
+    return build_recommender
 
-# Analytics system
+# Analytics system, imported on first use so workers start without loading pandas/sklearn
 def get_analytics(db=Depends(get_db)):
+    from analytics_system import AnalyticsSystem
     return AnalyticsSystem(db)
 
+@app.on_event("startup")
+def on_startup():
+    service_state.mark_serving()
+    if INGESTION_ENABLED:
+        interaction_counters.start(get_db())
+
+@app.on_event("shutdown")
+def on_shutdown():
+    # Write out counts still held in memory
+    if INGESTION_ENABLED:
+        interaction_counters.stop()
+
 class RecommendationResponse(BaseModel):
     entity_id: str
     entity_type: str
@@ -86,6 +142,20 @@ class RecommendationResponse(BaseModel):
     title: Optional[str] = None
     description: Optional[str] = None
 
+class BatchRecommendationRequest(BaseModel):
+    user_ids: List[str]
+    entity_types: List[str] = ENTITY_TYPES
+    max_recommendations: int = Field(5, ge=1, le=SNAPSHOT_TOP_K)
+
+class InteractionEvent(BaseModel):
+    entity_type: str
+    entity_id: str
+    user_id: Optional[str] = None
+    count: int = Field(1, ge=1, le=INGESTION_MAX_EVENT_COUNT)
+
+class IngestRequest(BaseModel):
+    events: List[InteractionEvent]
+
 class TrendingResponse(BaseModel):
     entity_id: str
     total_engagement: int
@@ -107,21 +177,56 @@ class EngagementResponse(BaseModel):
 def root():
     return {"status": "online", "message": "Content Recommendation API is running"}
 
+@app.get("/health/live")
+def liveness():
+    return {"status": "alive"}
+
+@app.get("/health/ready")
+def readiness(db=Depends(get_db)):
+    # Ready as soon as persisted suggestions can be served, the first refresh may still be running
+    state = service_state.snapshot()
+    try:
+        db.table('suggestions').select('id').limit(1).execute()
+    except Exception as e:
+        return JSONResponse(status_code=503, content={"status": "unavailable", "detail": str(e), **state})
+    return {"status": "ready", **state}
+
+@app.get("/metrics")
+def metrics():
+    state = service_state.snapshot()
+    if INGESTION_ENABLED:
+        state['ingestion_pending'] = interaction_counters.pending()
+    return state
+
 @app.get("/recommendations/{user_id}", response_model=Dict[str, List[RecommendationResponse]])
 @limiter.limit("60/minute")
 async def get_recommendations(
     request: Request, 
     user_id: str,
-    recommender: ContentRecommender = Depends(get_recommender),
+    build_recommender=Depends(get_recommender),
     db=Depends(get_db)
 ):
     try:
+        cache_key = ('recommendations', user_id)
+        version = data_version('model')
+        cached = response_cache.get(cache_key, version)
+        if cached:
+            return response_cache.respond(request, cached, shared=False)
+            
+        # Published snapshots answer without a database round-trip
+        snapshot = snapshots.current()
         results = {}
+        recommender = None
+        live = False
         for entity_type in ['videos', 'events', 'projects']:
-            suggestions = db.table('suggestions').select('*')\
+            published = snapshot.recommendations(user_id, entity_type) if snapshot else None
+            if published is not None:
+                results[entity_type] = published
+                continue
+                
+            suggestions = visible_suggestions(db)\
                 .eq('user_id', user_id)\
                 .eq('entity_type', entity_type)\
-                .gt('expires_at', datetime.now().isoformat())\
                 .execute()
                 
             if suggestions.data:
@@ -145,9 +250,11 @@ async def get_recommendations(
                 
                 results[entity_type] = enhanced_suggestions
             else:
-                # Generate new recommendations if none exist
+                # Users missing from the snapshot are folded in live; the result follows their
+                # interactions, so it is neither saved nor cached
+                recommender = recommender or build_recommender()
                 new_recommendations = recommender.get_user_recommendations(user_id, entity_type)
-                recommender.save_user_recommendations(user_id, new_recommendations, entity_type)
+                live = True
                 
                 enhanced_recommendations = []
                 for entity_id, score in new_recommendations:
@@ -169,7 +276,9 @@ async def get_recommendations(
                 
                 results[entity_type] = enhanced_recommendations
         
-        return results
+        if live:
+            return response_cache.respond(request, response_cache.render(version, results), shared=False, max_age=0)
+        return response_cache.respond(request, response_cache.put(cache_key, version, results), shared=False)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -179,17 +288,27 @@ async def get_entity_recommendations(
     request: Request, 
     user_id: str, 
     entity_type: str,
-    recommender: ContentRecommender = Depends(get_recommender),
+    build_recommender=Depends(get_recommender),
     db=Depends(get_db)
 ):
     try:
         if entity_type not in ['videos', 'events', 'projects']:
             raise HTTPException(status_code=400, detail="Invalid entity type")
             
-        suggestions = db.table('suggestions').select('*')\
+        cache_key = ('recommendations', user_id, entity_type)
+        version = data_version('model')
+        cached = response_cache.get(cache_key, version)
+        if cached:
+            return response_cache.respond(request, cached, shared=False)
+            
+        snapshot = snapshots.current()
+        published = snapshot.recommendations(user_id, entity_type) if snapshot else None
+        if published is not None:
+            return response_cache.respond(request, response_cache.put(cache_key, version, published), shared=False)
+            
+        suggestions = visible_suggestions(db)\
             .eq('user_id', user_id)\
             .eq('entity_type', entity_type)\
-            .gt('expires_at', datetime.now().isoformat())\
             .execute()
             
         if suggestions.data:
@@ -211,11 +330,12 @@ async def get_entity_recommendations(
                     
                 enhanced_suggestions.append(enhanced_suggestion)
             
-            return enhanced_suggestions
+            return response_cache.respond(request, response_cache.put(cache_key, version, enhanced_suggestions), shared=False)
         else:
-            # Generate new recommendations if none exist
+            # Users missing from the snapshot are folded in live; the result follows their
+            # interactions, so it is neither saved nor cached
+            recommender = build_recommender()
             new_recommendations = recommender.get_user_recommendations(user_id, entity_type)
-            recommender.save_user_recommendations(user_id, new_recommendations, entity_type)
             
             enhanced_recommendations = []
             for entity_id, score in new_recommendations:
@@ -235,10 +355,100 @@ async def get_entity_recommendations(
                     
                 enhanced_recommendations.append(enhanced_recommendation)
             
-            return enhanced_recommendations
+            return response_cache.respond(request, response_cache.render(version, enhanced_recommendations),
+                                          shared=False, max_age=0)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def fetch_all_rows(build_query):
+    rows = []
+    while True:
+        page = build_query().order('id').range(len(rows), len(rows) + QUERY_PAGE_SIZE - 1).execute().data
+        rows.extend(page)
+        if len(page) < QUERY_PAGE_SIZE:
+            return rows
+
+def fetch_entity_details(db, entity_type, entity_ids, details):
+    # Only ids not already seen earlier in the batch are fetched
+    missing = [entity_id for entity_id in entity_ids if entity_id not in details]
+    for start in range(0, len(missing), BATCH_CHUNK_SIZE):
+        rows = db.table(entity_type).select('id,title,description')\
+            .in_('id', missing[start:start + BATCH_CHUNK_SIZE])\
+            .execute().data
+        for row in rows:
+            details[row['id']] = row
+    return details
+
+def batch_recommendation_lines(db, user_ids, entity_types, max_recommendations):
+    snapshot = snapshots.current()
+    details = {entity_type: {} for entity_type in entity_types}
+    try:
+        for start in range(0, len(user_ids), BATCH_CHUNK_SIZE):
+            chunk = user_ids[start:start + BATCH_CHUNK_SIZE]
+            results = {user_id: {} for user_id in chunk}
+            for user_id in chunk:
+                for entity_type in entity_types:
+                    published = snapshot.recommendations(user_id, entity_type, max_recommendations) if snapshot else None
+                    if published is not None:
+                        results[user_id][entity_type] = published
+                        
+            # One set-based query for every user and type the snapshot could not answer
+            missing_users = [user_id for user_id in chunk if len(results[user_id]) < len(entity_types)]
+            grouped = {}
+            if missing_users:
+                rows = fetch_all_rows(lambda: visible_suggestions(db)
+                                      .in_('user_id', missing_users)
+                                      .in_('entity_type', entity_types))
+                for row in rows:
+                    grouped.setdefault((row['user_id'], row['entity_type']), []).append(row)
+                    
+            for entity_type in entity_types:
+                for key in [key for key in grouped if key[1] == entity_type]:
+                    grouped[key] = sorted(grouped[key], key=lambda row: row['score'], reverse=True)[:max_recommendations]
+                entity_ids = {row['entity_id'] for key, rows in grouped.items() if key[1] == entity_type for row in rows}
+                fetch_entity_details(db, entity_type, list(entity_ids), details[entity_type])
+                
+                for user_id in missing_users:
+                    if entity_type in results[user_id]:
+                        continue
+                    results[user_id][entity_type] = [
+                        {
+                            'entity_id': row['entity_id'],
+                            'entity_type': entity_type,
+                            'score': row['score'],
+                            'title': details[entity_type].get(row['entity_id'], {}).get('title'),
+                            'description': details[entity_type].get(row['entity_id'], {}).get('description')
+                        }
+                        for row in grouped.get((user_id, entity_type), [])
+                    ]
+                    
+            for user_id in chunk:
+                yield json.dumps({'user_id': user_id, 'recommendations': results[user_id]}) + '\n'
+    except Exception as e:
+        # Headers are already sent once streaming starts, so failures end the stream with an error line
+        yield json.dumps({'error': str(e)}) + '\n'
+
+# Many users in one call, streamed as NDJSON (one line per user) as each chunk is ready.
+# Read-only: users without published suggestions get empty lists instead of live generation.
+@app.post("/recommendations/batch")
+@limiter.limit("30/minute")
+async def get_batch_recommendations(
+    request: Request,
+    batch: BatchRecommendationRequest,
+    db=Depends(get_db)
+):
+    entity_types = list(dict.fromkeys(batch.entity_types))
+    if not entity_types or any(entity_type not in ENTITY_TYPES for entity_type in entity_types):
+        raise HTTPException(status_code=400, detail="Invalid entity type")
+    user_ids = list(dict.fromkeys(batch.user_ids))
+    if len(user_ids) > BATCH_MAX_USERS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_USERS} users per batch")
+        
+    return StreamingResponse(
+        batch_recommendation_lines(db, user_ids, entity_types, batch.max_recommendations),
+        media_type='application/x-ndjson'
+    )
+
 @app.get("/related/{entity_type}/{entity_id}", response_model=List[RecommendationResponse])
 @limiter.limit("100/minute")
 async def get_related_entities(
@@ -246,13 +456,24 @@ async def get_related_entities(
     entity_type: str, 
     entity_id: str,
     user_id: Optional[str] = None,
-    recommender: ContentRecommender = Depends(get_recommender),
+    build_recommender=Depends(get_recommender),
     db=Depends(get_db)
 ):
     try:
         if entity_type not in ['videos', 'events', 'projects']:
             raise HTTPException(status_code=400, detail="Invalid entity type")
             
+        cache_key = ('related', entity_type, entity_id, user_id)
+        version = data_version('model')
+        cached = response_cache.get(cache_key, version)
+        if cached:
+            return response_cache.respond(request, cached)
+            
+        snapshot = snapshots.current()
+        published = snapshot.related(entity_type, entity_id) if snapshot else None
+        if published is not None:
+            return response_cache.respond(request, response_cache.put(cache_key, version, published))
+            
         singular_type = entity_type[:-1]
         
         # If no user_id provided, get the first user from the database
@@ -264,20 +485,17 @@ async def get_related_entities(
                 raise HTTPException(status_code=404, detail="No users found in database")
         
         # Get suggestions for this entity, looking for related entities
-        suggestions = db.table('suggestions').select('*')\
+        suggestions = visible_suggestions(db)\
             .eq('user_id', user_id)\
             .eq('entity_type', f'related_{singular_type}')\
             .eq('original_entity_id', entity_id)\
-            .gt('expires_at', datetime.now().isoformat())\
             .execute()
             
         if not suggestions.data:
             # Try without the original_entity_id field (for compatibility)
-            query = db.table('suggestions')\
-                .select('*')\
+            query = visible_suggestions(db)\
                 .eq('user_id', user_id)\
-                .eq('entity_type', f'related_{singular_type}')\
-                .gt('expires_at', datetime.now().isoformat())
+                .eq('entity_type', f'related_{singular_type}')
                 
             suggestions = query.execute()
             
@@ -305,9 +523,10 @@ async def get_related_entities(
                     
                 enhanced_suggestions.append(enhanced_suggestion)
             
-            return enhanced_suggestions
+            return response_cache.respond(request, response_cache.put(cache_key, version, enhanced_suggestions))
         else:
             # Generate new recommendations if none exist
+            recommender = build_recommender()
             similar_entities = recommender.find_similar_entities_for(entity_id, entity_type)
             recommender.save_similar_entities(entity_id, similar_entities, entity_type)
             
@@ -329,7 +548,7 @@ async def get_related_entities(
                     
                 enhanced_recommendations.append(enhanced_recommendation)
             
-            return enhanced_recommendations
+            return response_cache.respond(request, response_cache.put(cache_key, version, enhanced_recommendations))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -340,13 +559,19 @@ async def get_trending_entities(
     entity_type: str,
     days: int = 7,
     limit: int = 5,
-    analytics: AnalyticsSystem = Depends(get_analytics),
+    analytics=Depends(get_analytics),
     db=Depends(get_db)
 ):
     try:
         if entity_type not in ['event', 'project', 'video']:
             raise HTTPException(status_code=400, detail="Invalid entity type")
             
+        cache_key = ('trending', entity_type, days, limit)
+        version = data_version('analytics')
+        cached = response_cache.get(cache_key, version)
+        if cached:
+            return response_cache.respond(request, cached)
+            
         trending = analytics.get_trending_entities(entity_type, days, limit)
         
         enhanced_trending = []
@@ -366,7 +591,7 @@ async def get_trending_entities(
                 
             enhanced_trending.append(enhanced_item)
             
-        return enhanced_trending
+        return response_cache.respond(request, response_cache.put(cache_key, version, enhanced_trending))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -377,7 +602,7 @@ async def predict_future_engagement(
     entity_type: str, 
     entity_id: str,
     days: int = 7,
-    analytics: AnalyticsSystem = Depends(get_analytics)
+    analytics=Depends(get_analytics)
 ):
     try:
         if entity_type not in ['event', 'project', 'video']:
@@ -396,7 +621,7 @@ async def predict_future_engagement(
 async def get_user_engagement(
     request: Request, 
     user_id: str,
-    analytics: AnalyticsSystem = Depends(get_analytics)
+    analytics=Depends(get_analytics)
 ):
     try:
         engagement = analytics.calculate_user_engagement(user_id)
@@ -404,23 +629,40 @@ async def get_user_engagement(
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/ingest")
+@limiter.limit("1200/minute")
+async def ingest_interactions(request: Request, batch: IngestRequest):
+    if not INGESTION_ENABLED:
+        raise HTTPException(status_code=503, detail="Ingestion is disabled")
+    if any(event.entity_type not in INGESTED_ENTITY_TYPES for event in batch.events):
+        raise HTTPException(status_code=400, detail="Invalid entity type")
+        
+    # Counted in memory only, the flush thread writes the deltas to `status`
+    for event in batch.events:
+        interaction_counters.record(event.entity_type, event.entity_id, event.user_id, event.count)
+    return {"accepted": len(batch.events)}
+
 @app.post("/trigger-update")
 @limiter.limit("10/hour")
-async def trigger_update(
-    request: Request,
-    recommender: ContentRecommender = Depends(get_recommender),
-    analytics: AnalyticsSystem = Depends(get_analytics)
-):
+async def trigger_update(request: Request):
     try:
-        # Update recommendations in background thread
-        recommendation_thread = threading.Thread(target=recommender.generate_all_recommendations)
-        recommendation_thread.daemon = True
-        recommendation_thread.start()
+        from main import run_in_process, snapshot_interactions, update_recommendations, update_analytics
         
-        # Update analytics
-        analytics_thread = threading.Thread(target=analytics.calculate_visitor_stats)
-        analytics_thread.daemon = True
-        analytics_thread.start()
+        # Each update runs in its own non-daemonic process (training may spawn its own
+        # workers) and publishes a new snapshot for every worker; the thread only waits on them.
+        # A manual refresh downloads the interactions first instead of reusing a snapshot that
+        # may be up to INTERACTION_SNAPSHOT_MAX_AGE old.
+        def run_updates():
+            for target in [snapshot_interactions, update_recommendations, update_analytics]:
+                try:
+                    run_in_process(target)
+                except Exception:
+                    # The update has already logged its own error, carry on with the next one
+                    continue
+                    
+        thread = threading.Thread(target=run_updates)
+        thread.daemon = True
+        thread.start()
         
         return {"status": "update_triggered", "message": "Update processes started in background"}
     except Exception as e:
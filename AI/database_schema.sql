@@ -44,16 +44,37 @@ CREATE TABLE status (
     created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
 );
 
+CREATE TABLE user_blocked (
+    id TEXT PRIMARY KEY,
+    blocker_id TEXT NOT NULL,
+    blocked_id TEXT NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
 CREATE TABLE suggestions (
     id TEXT PRIMARY KEY,
     user_id TEXT NOT NULL,
     entity_type TEXT NOT NULL,
     entity_id TEXT NOT NULL,
+    original_entity_id TEXT,
+    run_id TEXT,
     score FLOAT NOT NULL,
     created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
     expires_at TIMESTAMP WITH TIME ZONE NOT NULL
 );
 
+CREATE INDEX idx_suggestions_lookup ON suggestions(user_id, entity_type, run_id);
+CREATE INDEX idx_suggestions_expires_at ON suggestions(expires_at);
+CREATE INDEX idx_suggestions_run_id ON suggestions(run_id);
+
+CREATE TABLE suggestion_runs (
+    run_id TEXT PRIMARY KEY,
+    status TEXT NOT NULL DEFAULT 'running',
+    started_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    completed_at TIMESTAMP WITH TIME ZONE,
+    CONSTRAINT valid_run_status CHECK (status IN ('running', 'published', 'superseded', 'failed'))
+);
+
 CREATE TABLE tasks (
     task_id TEXT PRIMARY KEY,
     user_id TEXT NOT NULL,
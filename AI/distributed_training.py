@@ -0,0 +1,222 @@
+import argparse
+import json
+import os
+import socket
+import time
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from id_index import IdIndex
+from recommendation_system import RecommendationModel, EarlyStopping, train_epoch, evaluate_model, batch_settings
+from service_state import cache_path
+
+# Data-parallel training of RecommendationModel over the gloo backend. Every rank trains on
+# an interleaved shard of the interaction pairs and gradients are all-reduced each batch;
+# rank 0 evaluates, decides when to stop and writes the checkpoint.
+#
+# Locally the batch job spawns the ranks itself (TRAINING_WORLD_SIZE). On a cluster, write
+# the training data to a RECOMMENDER_CACHE_DIR shared by all hosts with
+#     python distributed_training.py --prepare
+# then start one rank per process with torchrun, e.g.
+#     torchrun --nnodes=4 --nproc-per-node=8 --rdzv-endpoint=host:29500 distributed_training.py videos
+# for each entity type, and finally score and publish from the checkpoints with
+#     python distributed_training.py --publish
+
+# Sparse embedding gradients only exchange the rows each batch touched
+SPARSE_EMBEDDINGS = os.getenv('TRAINING_SPARSE_EMBEDDINGS', '1') == '1'
+
+class CombinedOptimizer:
+    # SparseAdam for sparse embedding gradients, Adam for the dense network
+    def __init__(self, optimizers):
+        self.optimizers = optimizers
+
+    def zero_grad(self):
+        for optimizer in self.optimizers:
+            optimizer.zero_grad()
+
+    def step(self):
+        for optimizer in self.optimizers:
+            optimizer.step()
+
+def build_optimizer(model, sparse, learning_rate):
+    if not sparse:
+        return torch.optim.Adam(model.parameters(), lr=learning_rate)
+    embeddings = list(model.user_features.parameters()) + list(model.entity_features.parameters())
+    return CombinedOptimizer([
+        torch.optim.SparseAdam(embeddings, lr=learning_rate),
+        torch.optim.Adam(model.recommendation_network.parameters(), lr=learning_rate)
+    ])
+
+def data_path(entity_type, name):
+    return cache_path('training', f"{entity_type}.{name}")
+
+def write_training_data(entity_type, training_pairs, validation_pairs, user_count, entity_count,
+                        training_rounds=10, time_budget=None, max_recommendations=5):
+    np.save(data_path(entity_type, 'training.npy'), np.ascontiguousarray(training_pairs, dtype=np.int64))
+    np.save(data_path(entity_type, 'validation.npy'), np.ascontiguousarray(validation_pairs, dtype=np.int64))
+    with open(data_path(entity_type, 'json'), 'w') as config_file:
+        json.dump({
+            'user_count': user_count,
+            'entity_count': entity_count,
+            'training_rounds': training_rounds,
+            'time_budget': time_budget,
+            'max_recommendations': max_recommendations
+        }, config_file)
+
+def load_checkpoint(entity_type):
+    with open(data_path(entity_type, 'json')) as config_file:
+        config = json.load(config_file)
+    model = RecommendationModel(config['user_count'], config['entity_count'])
+    model.load_state_dict(torch.load(data_path(entity_type, 'pt')))
+    with open(data_path(entity_type, 'history.json')) as history_file:
+        history = json.load(history_file)
+    return model, history
+
+def load_prepared_checkpoint(entity_type, user_index, entity_index):
+    # Users and entities may have been added or removed since --prepare. Rows are matched by
+    # id: known ones keep their trained embedding, unknown ones start at the mean trained
+    # embedding and rows of ids that no longer exist are dropped.
+    model, history = load_checkpoint(entity_type)
+    remapped = RecommendationModel(len(user_index), len(entity_index), model.user_features.embedding_dim)
+    remapped.recommendation_network.load_state_dict(model.recommendation_network.state_dict())
+    with torch.no_grad():
+        for name, features, index in [('users', 'user_features', user_index),
+                                      ('entities', 'entity_features', entity_index)]:
+            trained = getattr(model, features).weight
+            table = getattr(remapped, features).weight
+            rows = IdIndex.load(data_path(entity_type, name)).lookup_index(index)
+            known = np.flatnonzero(rows >= 0)
+            table[:] = trained.mean(dim=0)
+            table[torch.from_numpy(known)] = trained[torch.from_numpy(rows[known])]
+    return remapped, history
+
+def free_port():
+    # Lets overlapping local runs rendezvous without colliding on one fixed port
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        probe.bind(('127.0.0.1', 0))
+        return str(probe.getsockname()[1])
+
+def spawn_local(world_size, entity_type):
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ['MASTER_PORT'] = os.getenv('TRAINING_MASTER_PORT') or free_port()
+    mp.spawn(run_worker, args=(world_size, entity_type), nprocs=world_size, join=True)
+
+def run_worker(rank, world_size, entity_type):
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    try:
+        with open(data_path(entity_type, 'json')) as config_file:
+            config = json.load(config_file)
+        training_pairs = np.load(data_path(entity_type, 'training.npy'), mmap_mode='r')
+        validation_pairs = np.load(data_path(entity_type, 'validation.npy'))
+        shard = np.asarray(training_pairs[rank::world_size])
+        user_count = config['user_count']
+        entity_count = config['entity_count']
+
+        # Same seed everywhere, DDP also broadcasts rank 0's initial weights
+        torch.manual_seed(0)
+        model = RecommendationModel(user_count, entity_count, sparse=SPARSE_EMBEDDINGS)
+        parallel_model = DistributedDataParallel(model)
+        # Sized on the shard so each rank takes as many steps as the single-process run
+        batch_size, learning_rate = batch_settings(len(shard))
+        optimizer = build_optimizer(model, SPARSE_EMBEDDINGS, learning_rate)
+        rng = np.random.default_rng(rank)
+        early_stopping = EarlyStopping()
+        history = []
+        started_at = time.monotonic()
+
+        for epoch in range(config['training_rounds']):
+            epoch_started_at = time.monotonic()
+            # join() lets ranks with one batch fewer finish without stalling the all-reduce
+            with parallel_model.join():
+                shard_loss = train_epoch(parallel_model, optimizer, shard, entity_count, rng, batch_size)
+            loss = torch.tensor([shard_loss * len(shard), len(shard)], dtype=torch.float64)
+            dist.all_reduce(loss)
+
+            stop = torch.zeros(1)
+            if rank == 0:
+                record = {'epoch': epoch + 1, 'train_loss': float(loss[0] / max(loss[1], 1))}
+                if len(validation_pairs):
+                    record.update(evaluate_model(
+                        model, validation_pairs, np.asarray(training_pairs), user_count, entity_count,
+                        config['max_recommendations']
+                    ))
+                record['seconds'] = round(time.monotonic() - epoch_started_at, 3)
+                record['world_size'] = world_size
+                history.append(record)
+                save_checkpoint(entity_type, model, history)
+
+                budget = config['time_budget']
+                if len(validation_pairs) and early_stopping.update(model, record):
+                    stop[0] = 1
+                elif budget and time.monotonic() - started_at + record['seconds'] > budget:
+                    stop[0] = 1
+            dist.broadcast(stop, src=0)
+            if stop.item():
+                break
+
+        if rank == 0:
+            early_stopping.restore(model)
+            save_checkpoint(entity_type, model, history)
+    finally:
+        dist.destroy_process_group()
+
+def save_checkpoint(entity_type, model, history):
+    path = data_path(entity_type, 'pt')
+    torch.save(model.state_dict(), f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
+    with open(data_path(entity_type, 'history.json'), 'w') as history_file:
+        json.dump(history, history_file)
+
+def train_distributed(entity_type, training_pairs, validation_pairs, user_count, entity_count,
+                      training_rounds, time_budget, max_recommendations, world_size):
+    write_training_data(entity_type, training_pairs, validation_pairs, user_count, entity_count,
+                        training_rounds, time_budget, max_recommendations)
+    spawn_local(world_size, entity_type)
+    return load_checkpoint(entity_type)
+
+def prepare():
+    from dotenv import load_dotenv
+    from supabase import create_client
+    from recommendation_system import ContentRecommender, TRAINING_TIME_BUDGETS
+
+    load_dotenv()
+    recommender = ContentRecommender(create_client(os.getenv('SUPABASE_URL'), os.getenv('SUPABASE_KEY')))
+    user_data = recommender.load_user_data()
+    for entity_type, interactions in [('videos', user_data['video_interactions']),
+                                      ('events', user_data['event_participants']),
+                                      ('projects', user_data['project_members'])]:
+        training_pairs, validation_pairs = recommender.training_pairs(interactions, entity_type)
+        write_training_data(entity_type, training_pairs, validation_pairs, len(recommender.user_to_index),
+                            len(recommender.entity_to_index[entity_type]),
+                            time_budget=TRAINING_TIME_BUDGETS.get(entity_type))
+        recommender.user_to_index.save(data_path(entity_type, 'users'))
+        recommender.entity_to_index[entity_type].save(data_path(entity_type, 'entities'))
+
+def publish():
+    from dotenv import load_dotenv
+    from supabase import create_client
+    from recommendation_system import ContentRecommender
+
+    load_dotenv()
+    recommender = ContentRecommender(create_client(os.getenv('SUPABASE_URL'), os.getenv('SUPABASE_KEY')))
+    recommender.checkpoint_models = True
+    recommender.generate_all_recommendations()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Data-parallel RecommendationModel training')
+    parser.add_argument('entity_type', nargs='?', choices=['videos', 'events', 'projects'])
+    parser.add_argument('--prepare', action='store_true', help='write training data for every entity type')
+    parser.add_argument('--publish', action='store_true', help='score and publish from the trained checkpoints')
+    parser.add_argument('--world-size', type=int, default=2, help='local processes when not started by torchrun')
+    args = parser.parse_args()
+
+    if args.prepare:
+        prepare()
+    elif args.publish:
+        publish()
+    elif 'RANK' in os.environ:
+        run_worker(int(os.environ['RANK']), int(os.environ['WORLD_SIZE']), args.entity_type)
+    else:
+        spawn_local(args.world_size, args.entity_type)
@@ -0,0 +1,66 @@
+import os
+import numpy as np
+import torch
+import torch.nn.functional as F
+from quantization import QuantizedModel, dequantize_rows
+
+FOLD_IN_STEPS = int(os.getenv('FOLD_IN_STEPS', '20'))
+FOLD_IN_LEARNING_RATE = 0.05
+# Sampled negative entities per interaction
+FOLD_IN_NEGATIVES = 4
+# Folded-in users kept per model generation before the oldest are dropped
+FOLD_IN_MAX_USERS = int(os.getenv('FOLD_IN_MAX_USERS', '100000'))
+
+# User and entity embeddings are concatenated into an MLP rather than compared by dot
+# product, so an average of item vectors is not a user vector. Instead a new user's
+# vector starts at the mean user embedding and takes a few gradient steps on their
+# interactions, with the entity table and network frozen.
+def fold_in_vector(model, entity_positions, entity_count, steps=FOLD_IN_STEPS, rng=None):
+    prior, entity_rows, layers = _frozen_network(model)
+    rng = rng if rng is not None else np.random.default_rng()
+    positives = np.unique(np.asarray(entity_positions, dtype=np.int64))
+    negatives = rng.integers(0, entity_count, len(positives) * FOLD_IN_NEGATIVES)
+    entities = torch.from_numpy(entity_rows(np.concatenate([positives, negatives])))
+    labels = torch.cat([torch.ones(len(positives)), torch.zeros(len(negatives))])
+
+    user = torch.tensor(prior, dtype=torch.float32, requires_grad=True)
+    optimizer = torch.optim.Adam([user], lr=FOLD_IN_LEARNING_RATE)
+    for _ in range(steps):
+        optimizer.zero_grad()
+        hidden = torch.cat([user.expand(len(entities), -1), entities], dim=1)
+        for i, (weight, bias) in enumerate(layers):
+            hidden = hidden @ weight.T + bias
+            if i < len(layers) - 1:
+                hidden = torch.relu(hidden)
+        loss = F.binary_cross_entropy_with_logits(hidden[:, 0], labels)
+        loss.backward()
+        optimizer.step()
+    return user.detach().numpy()
+
+def _frozen_network(model):
+    # (mean user vector, entity row getter, [(weight, bias)]) without the final sigmoid
+    if isinstance(model, QuantizedModel):
+        layers = [(model.layer_weight(i), model.layers[i][2]) for i in range(len(model.layers))]
+        prior = model.user_prior
+        if prior is None:
+            prior = np.zeros(model.tables['entity_features'][0].shape[1], dtype=np.float32)
+        entity_rows = lambda positions: dequantize_rows(*model.tables['entity_features'], positions)
+    else:
+        layers = [
+            (layer.weight.detach().numpy(), layer.bias.detach().numpy())
+            for layer in model.recommendation_network if hasattr(layer, 'weight')
+        ]
+        prior = model.user_features.weight.detach().numpy().mean(axis=0)
+        entity_table = model.entity_features.weight.detach().numpy()
+        entity_rows = lambda positions: np.ascontiguousarray(entity_table[positions])
+    layers = [
+        (torch.tensor(np.asarray(weight), dtype=torch.float32), torch.tensor(np.asarray(bias), dtype=torch.float32))
+        for weight, bias in layers
+    ]
+    return np.asarray(prior, dtype=np.float32), entity_rows, layers
+
+def remember(folded_users, user_id, vector):
+    if user_id not in folded_users and len(folded_users) >= FOLD_IN_MAX_USERS:
+        folded_users.pop(next(iter(folded_users)))
+    folded_users[user_id] = vector
+    return vector
@@ -0,0 +1,120 @@
+import json
+import os
+import uuid
+import numpy as np
+
+# Sorted, packed array of ids mapping each id to its position. Ids that are all
+# canonical UUIDs are stored as 16 raw bytes each, anything else as fixed-width
+# utf-8 bytes. Positions follow the sorted id order, so they are stable across
+# runs for the same set of ids.
+class IdIndex:
+    def __init__(self, ids, packed_uuids=False):
+        self.ids = ids
+        self.packed_uuids = packed_uuids
+
+    @classmethod
+    def from_ids(cls, ids):
+        ids = [str(entity_id) for entity_id in ids]
+        packed_uuids = bool(ids) and all(_is_uuid(entity_id) for entity_id in ids)
+        encoded = _encode(ids, packed_uuids)
+        return cls(np.unique(encoded), packed_uuids)
+
+    @classmethod
+    def union(cls, indexes):
+        indexes = [index for index in indexes if len(index)]
+        if indexes and len({index.packed_uuids for index in indexes}) == 1:
+            return cls(np.unique(np.concatenate([np.asarray(index.ids) for index in indexes])),
+                       indexes[0].packed_uuids)
+        return cls.from_ids(entity_id for index in indexes for entity_id in index)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        with open(f"{path}.json") as meta_file:
+            meta = json.load(meta_file)
+        ids = np.load(f"{path}.npy", mmap_mode='r' if mmap else None)
+        return cls(ids, meta['packed_uuids'])
+
+    def save(self, path):
+        # Written to temporary files first so readers never map a half-written index
+        with open(f"{path}.npy.tmp", 'wb') as ids_file:
+            np.save(ids_file, np.ascontiguousarray(self.ids))
+        with open(f"{path}.json.tmp", 'w') as meta_file:
+            json.dump({'packed_uuids': self.packed_uuids, 'size': len(self)}, meta_file)
+        os.replace(f"{path}.npy.tmp", f"{path}.npy")
+        os.replace(f"{path}.json.tmp", f"{path}.json")
+
+    # Maps a sequence of ids to positions in bulk, -1 for unknown ids
+    def lookup(self, ids):
+        ids = [str(entity_id) for entity_id in ids]
+        if not ids or len(self.ids) == 0:
+            return np.full(len(ids), -1, dtype=np.int64)
+        if self.packed_uuids:
+            known = np.array([_is_uuid(entity_id) for entity_id in ids], dtype=bool)
+            encoded = _encode([entity_id if ok else str(uuid.UUID(int=0)) for entity_id, ok in zip(ids, known)], True)
+        else:
+            known = np.ones(len(ids), dtype=bool)
+            encoded = _encode(ids, False)
+        positions = np.searchsorted(self.ids, encoded)
+        clipped = np.minimum(positions, len(self.ids) - 1)
+        found = known & (positions < len(self.ids)) & (self.ids[clipped] == encoded)
+        return np.where(found, positions, -1).astype(np.int64)
+
+    # Positions of every id of another index, compared in packed form when the layouts match
+    def lookup_index(self, other):
+        if other.packed_uuids != self.packed_uuids:
+            return self.lookup(list(other))
+        if len(other) == 0 or len(self.ids) == 0:
+            return np.full(len(other), -1, dtype=np.int64)
+        encoded = np.asarray(other.ids)
+        positions = np.searchsorted(self.ids, encoded)
+        clipped = np.minimum(positions, len(self.ids) - 1)
+        found = (positions < len(self.ids)) & (self.ids[clipped] == encoded)
+        return np.where(found, positions, -1).astype(np.int64)
+
+    def id_at(self, position):
+        return self._decode(self.ids[position])
+
+    def ids_at(self, positions):
+        return [self._decode(value) for value in self.ids[np.asarray(positions, dtype=np.int64)]]
+
+    def _decode(self, value):
+        if self.packed_uuids:
+            return str(uuid.UUID(bytes=bytes(value).ljust(16, b'\0')))
+        return bytes(value).decode('utf-8')
+
+    def get(self, entity_id, default=None):
+        position = self.lookup([entity_id])[0]
+        return default if position < 0 else int(position)
+
+    def __getitem__(self, entity_id):
+        position = self.get(entity_id)
+        if position is None:
+            raise KeyError(entity_id)
+        return position
+
+    def __contains__(self, entity_id):
+        return self.get(entity_id) is not None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        for value in self.ids:
+            yield self._decode(value)
+
+    def items(self):
+        for position, value in enumerate(self.ids):
+            yield self._decode(value), position
+
+def _is_uuid(value):
+    try:
+        return str(uuid.UUID(value)) == value.lower()
+    except (ValueError, AttributeError, TypeError):
+        return False
+
+def _encode(ids, packed_uuids):
+    if packed_uuids:
+        return np.array([uuid.UUID(entity_id).bytes for entity_id in ids], dtype='S16')
+    if not ids:
+        return np.array([], dtype='S1')
+    return np.array([entity_id.encode('utf-8') for entity_id in ids], dtype=bytes)
@@ -0,0 +1,107 @@
+import logging
+import os
+import threading
+import uuid
+from collections import Counter
+from datetime import datetime
+from service_state import bump_data_version
+
+# With ingestion on, `status` holds per-day deltas written here and the scheduled
+# full-table recount is skipped (it would add all-time totals on top of them)
+INGESTION_ENABLED = os.getenv('INGESTION_ENABLED', '0') == '1'
+INGESTION_FLUSH_INTERVAL = float(os.getenv('INGESTION_FLUSH_INTERVAL', '30'))
+# Rows per bulk insert into `status`
+INGESTION_FLUSH_BATCH = 500
+# Upper bound on the count one posted event may carry
+INGESTION_MAX_EVENT_COUNT = int(os.getenv('INGESTION_MAX_EVENT_COUNT', '1000'))
+ENTITY_TYPES = ['video', 'event', 'project']
+
+logger = logging.getLogger(__name__)
+
+# In-memory interaction counters for one API worker. Events only touch the counters;
+# a background thread periodically writes the aggregated deltas to `status` and bumps
+# the analytics version so trending responses pick them up. Each worker flushes its own
+# deltas, which add up because trending sums visitor_count over the rows of a window.
+class InteractionCounters:
+    def __init__(self, flush_interval=INGESTION_FLUSH_INTERVAL, batch_size=INGESTION_FLUSH_BATCH):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.entity_counts = Counter()
+        self.user_counts = Counter()
+        self.lock = threading.Lock()
+        self.database = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def record(self, entity_type, entity_id, user_id=None, count=1):
+        with self.lock:
+            self.entity_counts[(entity_type, entity_id)] += count
+            if user_id:
+                self.user_counts[user_id] += count
+
+    def pending(self):
+        with self.lock:
+            return {'entities': len(self.entity_counts), 'users': len(self.user_counts)}
+
+    def flush(self, database=None):
+        database = database or self.database
+        with self.lock:
+            entity_counts, self.entity_counts = self.entity_counts, Counter()
+            user_counts, self.user_counts = self.user_counts, Counter()
+        if not entity_counts and not user_counts:
+            return 0
+
+        today = datetime.now().date().isoformat()
+        # Per-user activity is stored alongside the entities under entity_type 'user'
+        rows = [
+            {'id': str(uuid.uuid4()), 'entity_type': entity_type, 'entity_id': entity_id,
+             'visitor_count': count, 'date': today}
+            for (entity_type, entity_id), count in entity_counts.items()
+        ] + [
+            {'id': str(uuid.uuid4()), 'entity_type': 'user', 'entity_id': user_id,
+             'visitor_count': count, 'date': today}
+            for user_id, count in user_counts.items()
+        ]
+        written = 0
+        try:
+            for start in range(0, len(rows), self.batch_size):
+                database.table('status').insert(rows[start:start + self.batch_size]).execute()
+                written = start + self.batch_size
+        except Exception:
+            # Put back whatever was not written so the next flush retries it
+            with self.lock:
+                for row in rows[written:]:
+                    if row['entity_type'] == 'user':
+                        self.user_counts[row['entity_id']] += row['visitor_count']
+                    else:
+                        self.entity_counts[(row['entity_type'], row['entity_id'])] += row['visitor_count']
+            raise
+        finally:
+            if written:
+                bump_data_version('analytics')
+        return len(rows)
+
+    def start(self, database):
+        self.database = database
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.database is not None:
+            self._flush_logged()
+
+    def _run(self):
+        while not self.stopped.wait(self.flush_interval):
+            self._flush_logged()
+
+    def _flush_logged(self):
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error(f"Error flushing interaction counters: {str(e)}")
@@ -0,0 +1,105 @@
+import os
+import time
+import numpy as np
+from id_index import IdIndex
+from service_state import cache_path
+
+# Interaction tables and the column holding the entity id
+INTERACTION_TABLES = {
+    'video_interactions': 'video_id',
+    'event_participants': 'event_id',
+    'project_members': 'project_id'
+}
+# A snapshot younger than this is reused instead of downloading the tables again. Just over
+# two hours covers the gap between an analytics run and the recommendation run after it.
+INTERACTION_SNAPSHOT_MAX_AGE = float(os.getenv('INTERACTION_SNAPSHOT_MAX_AGE', '7800'))
+# PostgREST caps the rows returned per request
+FETCH_PAGE_SIZE = 1000
+
+# One interaction table in columnar form: each row is a (user code, entity code) pair
+# into the table's own sorted IdIndex dictionaries of users and entities
+class InteractionTable:
+    def __init__(self, name, users, user_codes, entities, entity_codes):
+        self.name = name
+        self.entity_key = INTERACTION_TABLES[name]
+        self.users = users
+        self.user_codes = user_codes
+        self.entities = entities
+        self.entity_codes = entity_codes
+
+    @classmethod
+    def from_rows(cls, name, rows):
+        entity_key = INTERACTION_TABLES[name]
+        rows = [row for row in rows if row.get('user_id') and row.get(entity_key)]
+        user_ids = [row['user_id'] for row in rows]
+        entity_ids = [row[entity_key] for row in rows]
+        users = IdIndex.from_ids(user_ids)
+        entities = IdIndex.from_ids(entity_ids)
+        return cls(name, users, users.lookup(user_ids).astype(np.int32),
+                   entities, entities.lookup(entity_ids).astype(np.int32))
+
+    def __len__(self):
+        return len(self.user_codes)
+
+    def user_positions(self, user_index):
+        # Positions in another index, -1 where the user is not in it
+        return user_index.lookup_index(self.users)[self.user_codes]
+
+    def entity_positions(self, entity_index):
+        return entity_index.lookup_index(self.entities)[self.entity_codes]
+
+    def entity_counts(self):
+        counts = np.bincount(self.entity_codes, minlength=len(self.entities))
+        return dict(zip(self.entities, counts.tolist()))
+
+def fetch_table(database, name):
+    rows = []
+    while True:
+        page = database.table(name).select(f"id,user_id,{INTERACTION_TABLES[name]}")\
+            .order('id')\
+            .range(len(rows), len(rows) + FETCH_PAGE_SIZE - 1)\
+            .execute().data
+        rows.extend(page)
+        if len(page) < FETCH_PAGE_SIZE:
+            return InteractionTable.from_rows(name, rows)
+
+def snapshot_path():
+    return cache_path('interactions', 'snapshot.npz')
+
+def refresh_interactions(database):
+    tables = {name: fetch_table(database, name) for name in INTERACTION_TABLES}
+    arrays = {}
+    for name, table in tables.items():
+        arrays[f"{name}.users"] = np.asarray(table.users.ids)
+        arrays[f"{name}.users_packed"] = np.array(table.users.packed_uuids)
+        arrays[f"{name}.user_codes"] = table.user_codes
+        arrays[f"{name}.entities"] = np.asarray(table.entities.ids)
+        arrays[f"{name}.entities_packed"] = np.array(table.entities.packed_uuids)
+        arrays[f"{name}.entity_codes"] = table.entity_codes
+    # Written aside and renamed so a pipeline never reads a half-written snapshot
+    path = snapshot_path()
+    with open(f"{path}.tmp", 'wb') as snapshot_file:
+        np.savez(snapshot_file, **arrays)
+    os.replace(f"{path}.tmp", path)
+    return tables
+
+def read_interactions():
+    with np.load(snapshot_path()) as arrays:
+        return {
+            name: InteractionTable(
+                name,
+                IdIndex(arrays[f"{name}.users"], bool(arrays[f"{name}.users_packed"])),
+                arrays[f"{name}.user_codes"],
+                IdIndex(arrays[f"{name}.entities"], bool(arrays[f"{name}.entities_packed"])),
+                arrays[f"{name}.entity_codes"]
+            )
+            for name in INTERACTION_TABLES
+        }
+
+def load_interactions(database, max_age=INTERACTION_SNAPSHOT_MAX_AGE):
+    try:
+        if time.time() - os.path.getmtime(snapshot_path()) < max_age:
+            return read_interactions()
+    except (FileNotFoundError, KeyError, ValueError):
+        pass
+    return refresh_interactions(database)
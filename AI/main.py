@@ -1,10 +1,10 @@
+import service_state
 from supabase import create_client
 import os
 from dotenv import load_dotenv
-from recommendation_system import ContentRecommender
-from analytics_system import AnalyticsSystem
 import uvicorn
 import threading
+import multiprocessing
 import time
 from datetime import datetime
 import logging
@@ -23,38 +23,130 @@ SUPABASE_KEY = os.getenv('SUPABASE_KEY')
 if not SUPABASE_URL or not SUPABASE_KEY:
     raise ValueError("Missing required environment variables SUPABASE_URL and/or SUPABASE_KEY")
 
+# 'fast' binds the API immediately and runs the first refresh in the background,
+# 'blocking' keeps the old behaviour of refreshing before the port opens
+STARTUP_MODE = os.getenv('STARTUP_MODE', 'fast')
+# API worker processes; they share model tables through the memory-mapped snapshot
+API_WORKERS = int(os.getenv('API_WORKERS', '1'))
+
 def update_recommendations():
     try:
         logger.info("Starting recommendation update process")
+        # Imported here so torch and sklearn are only loaded when training runs
+        from recommendation_system import ContentRecommender
         supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
         recommender = ContentRecommender(supabase)
         recommender.generate_all_recommendations()
+        for entity_type, history in recommender.training_history.items():
+            if history:
+                logger.info(
+                    f"Trained {entity_type} model: {len(history)} epochs in "
+                    f"{sum(epoch['seconds'] for epoch in history):.1f}s, last epoch {history[-1]}"
+                )
+        for entity_type, report in recommender.quantization_report.items():
+            if report:
+                logger.info(f"Quantized {entity_type} model: {report}")
         logger.info("Recommendation update process completed")
     except Exception as e:
         logger.error(f"Error in recommendation update: {str(e)}")
+        # Re-raised so the process exits non-zero and run_in_process reports the failure
+        raise
 
 def update_analytics():
     try:
+        # Ingested interactions already keep `status` current, a recount would double them
+        from ingestion import INGESTION_ENABLED
+        if INGESTION_ENABLED:
+            logger.info("Skipping analytics recount, interaction ingestion is enabled")
+            return
+            
         logger.info("Starting analytics update process")
+        from analytics_system import AnalyticsSystem
         supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
         analytics = AnalyticsSystem(supabase)
         analytics.calculate_visitor_stats()
         logger.info("Analytics update process completed")
     except Exception as e:
         logger.error(f"Error in analytics update: {str(e)}")
+        raise
+
+def snapshot_interactions():
+    try:
+        logger.info("Fetching interaction snapshot")
+        from interaction_snapshot import refresh_interactions
+        supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+        tables = refresh_interactions(supabase)
+        logger.info(f"Interaction snapshot written: { {name: len(table) for name, table in tables.items()} }")
+    except Exception as e:
+        logger.error(f"Error fetching interaction snapshot: {str(e)}")
+        raise
+
+def run_in_process(target):
+    # Training runs in its own process so it never competes with request handling for the
+    # GIL or leaves its tensors in a serving process; workers pick up the published snapshot
+    process = multiprocessing.get_context('spawn').Process(target=target)
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f"{target.__name__} exited with code {process.exitcode}")
+
+def compact_suggestions():
+    try:
+        logger.info("Starting suggestion compaction")
+        from suggestion_runs import SuggestionCompactor
+        supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+        report = SuggestionCompactor(supabase).compact()
+        logger.info(f"Suggestion compaction completed: {report}")
+    except Exception as e:
+        logger.error(f"Error in suggestion compaction: {str(e)}")
+
+def run_scheduled(target):
+    # A failed job is logged and retried at its next slot, not again within the same hour
+    try:
+        run_in_process(target)
+    except Exception as e:
+        logger.error(f"Scheduled {target.__name__} failed: {str(e)}")
+
+def initial_refresh():
+    started_at = time.monotonic()
+    service_state.mark_refresh_started()
+    try:
+        # One fresh download at start-up, shared by both pipelines below
+        run_in_process(snapshot_interactions)
+        run_in_process(update_recommendations)
+        run_in_process(update_analytics)
+        service_state.mark_refresh_finished(started_at)
+        logger.info(f"Initial refresh completed in {time.monotonic() - started_at:.1f}s")
+    except Exception as e:
+        service_state.mark_refresh_finished(started_at, e)
+        logger.error(f"Error in initial refresh: {str(e)}")
+
+def refresh_then_schedule():
+    # The scheduler waits for the first refresh, so a start in a scheduled hour never runs
+    # two recommendation updates side by side on the same cache files
+    initial_refresh()
+    scheduler()
 
 def scheduler():
     while True:
         try:
             current_hour = datetime.now().hour
             
+            # Each run reuses the interaction snapshot while it is younger than
+            # INTERACTION_SNAPSHOT_MAX_AGE, so the 2 AM/PM recommendation runs read the tables
+            # fetched for the midnight/noon analytics run instead of downloading them again
+            
             # Run recommendations update at specific times
             if current_hour in [2, 14]:  # 2 AM and 2 PM
-                update_recommendations()
+                run_scheduled(update_recommendations)
                 
             # Run analytics more frequently
             if current_hour % 4 == 0:  # Every 4 hours
-                update_analytics()
+                run_scheduled(update_analytics)
+                
+            # Clear expired and superseded suggestions after the recommendation runs
+            if current_hour in [3, 15]:
+                compact_suggestions()
                 
             # Sleep for an hour before checking again
             time.sleep(3600)
@@ -67,17 +159,20 @@ def main():
         logger.info("Starting application")
         
         # Initial update of both systems
-        update_recommendations()
-        update_analytics()
+        if STARTUP_MODE == 'blocking':
+            initial_refresh()
+            background_jobs = scheduler
+        else:
+            background_jobs = refresh_then_schedule
         
         # Start scheduler in background thread
-        scheduler_thread = threading.Thread(target=scheduler)
+        scheduler_thread = threading.Thread(target=background_jobs)
         scheduler_thread.daemon = True
         scheduler_thread.start()
         
         # Start API server
-        logger.info("Starting API server")
-        uvicorn.run("api:app", host="0.0.0.0", port=8000)
+        logger.info(f"Starting API server with {API_WORKERS} worker(s)")
+        uvicorn.run("api:app", host="0.0.0.0", port=8000, workers=API_WORKERS)
     except Exception as e:
         logger.error(f"Critical error in main application: {str(e)}")
 
@@ -0,0 +1,142 @@
+import json
+import os
+import shutil
+import numpy as np
+
+PRECISIONS = ['float32', 'float16', 'int8']
+
+def quantize_table(table, precision):
+    table = np.asarray(table, dtype=np.float32)
+    if precision == 'float32':
+        return table, None
+    if precision == 'float16':
+        return table.astype(np.float16), None
+    # Symmetric int8 with one scale per row keeps each embedding's own dynamic range
+    scales = np.abs(table).max(axis=1) / 127
+    scales[scales == 0] = 1
+    quantized = np.clip(np.rint(table / scales[:, None]), -127, 127).astype(np.int8)
+    return quantized, scales.astype(np.float32)
+
+def dequantize_rows(values, scales, rows):
+    rows = np.asarray(rows, dtype=np.int64)
+    dequantized = values[rows].astype(np.float32)
+    if scales is not None:
+        dequantized *= scales[rows][:, None]
+    return dequantized
+
+# Inference-only copy of a RecommendationModel with (optionally) quantized embedding tables
+# and MLP weights. Scoring runs on numpy and only dequantizes the rows it touches.
+class QuantizedModel:
+    def __init__(self, precision, tables, layers, user_prior=None):
+        self.precision = precision
+        self.tables = tables
+        self.layers = layers
+        # Mean user embedding, the starting point when folding in users trained without
+        self.user_prior = user_prior
+
+    @classmethod
+    def from_model(cls, model, precision='int8'):
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unsupported precision {precision}, expected one of {PRECISIONS}")
+
+        tables = {}
+        for name in ['user_features', 'entity_features']:
+            tables[name] = quantize_table(getattr(model, name).weight.detach().cpu().numpy(), precision)
+
+        layers = []
+        for layer in model.recommendation_network:
+            if hasattr(layer, 'weight'):
+                weight, scale = quantize_table(layer.weight.detach().cpu().numpy(), precision)
+                layers.append((weight, scale, layer.bias.detach().cpu().numpy().astype(np.float32)))
+        user_prior = model.user_features.weight.detach().cpu().numpy().mean(axis=0).astype(np.float32)
+        return cls(precision, tables, layers, user_prior)
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        with open(os.path.join(directory, 'manifest.json')) as manifest_file:
+            manifest = json.load(manifest_file)
+
+        def load_array(name):
+            path = os.path.join(directory, f"{name}.npy")
+            return np.load(path, mmap_mode='r' if mmap else None) if os.path.exists(path) else None
+
+        tables = {name: (load_array(name), load_array(f"{name}.scales")) for name in manifest['tables']}
+        layers = [
+            (load_array(f"layer{i}"), load_array(f"layer{i}.scales"), load_array(f"layer{i}.bias"))
+            for i in range(manifest['layers'])
+        ]
+        return cls(manifest['precision'], tables, layers, load_array('user_prior'))
+
+    def save(self, directory):
+        # Written to a fresh directory so files from an export at another precision never linger
+        final_directory = directory
+        directory = f"{final_directory}.tmp"
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+        arrays = {}
+        for name, (values, scales) in self.tables.items():
+            arrays[name] = values
+            arrays[f"{name}.scales"] = scales
+        for i, (weight, scales, bias) in enumerate(self.layers):
+            arrays[f"layer{i}"] = weight
+            arrays[f"layer{i}.scales"] = scales
+            arrays[f"layer{i}.bias"] = bias
+        arrays['user_prior'] = self.user_prior
+        for name, array in arrays.items():
+            if array is not None:
+                np.save(os.path.join(directory, f"{name}.npy"), np.ascontiguousarray(array))
+        with open(os.path.join(directory, 'manifest.json'), 'w') as manifest_file:
+            json.dump({'precision': self.precision, 'tables': list(self.tables), 'layers': len(self.layers)},
+                      manifest_file)
+        shutil.rmtree(final_directory, ignore_errors=True)
+        os.replace(directory, final_directory)
+
+    @property
+    def user_count(self):
+        return len(self.tables['user_features'][0])
+
+    @property
+    def entity_count(self):
+        return len(self.tables['entity_features'][0])
+
+    def nbytes(self):
+        arrays = [array for pair in self.tables.values() for array in pair if array is not None]
+        arrays += [array for layer in self.layers for array in layer if array is not None]
+        return sum(array.nbytes for array in arrays)
+
+    def score_users(self, user_positions, entity_positions=None):
+        return self.score_vectors(dequantize_rows(*self.tables['user_features'], user_positions), entity_positions)
+
+    def score_vectors(self, users, entity_positions=None):
+        # Same maths as RecommendationModel.forward for every (user, entity) pair. The first
+        # layer is split into its user and entity halves so each embedding is projected once.
+        if entity_positions is None:
+            entity_positions = np.arange(self.entity_count)
+        entities = dequantize_rows(*self.tables['entity_features'], entity_positions)
+
+        first_weight = self.layer_weight(0)
+        feature_size = users.shape[1]
+        user_part = users @ first_weight[:, :feature_size].T
+        entity_part = entities @ first_weight[:, feature_size:].T + self.layers[0][2]
+        hidden = np.maximum(user_part[:, None, :] + entity_part[None, :, :], 0)
+
+        for i in range(1, len(self.layers)):
+            hidden = hidden @ self.layer_weight(i).T + self.layers[i][2]
+            if i < len(self.layers) - 1:
+                hidden = np.maximum(hidden, 0)
+        return 1 / (1 + np.exp(-np.clip(hidden[..., 0], -60, 60)))
+
+    def layer_weight(self, i):
+        weight, scales, _ = self.layers[i]
+        weight = weight.astype(np.float32)
+        return weight * scales[:, None] if scales is not None else weight
+
+def topk_overlap(reference_scores, quantized_scores, k=5):
+    # Mean share of each user's float32 top-k that the quantized model also ranks in its top-k
+    k = min(k, reference_scores.shape[1])
+    if k == 0 or len(reference_scores) == 0:
+        return 1.0
+    reference = np.argpartition(-reference_scores, k - 1, axis=1)[:, :k]
+    quantized = np.argpartition(-quantized_scores, k - 1, axis=1)[:, :k]
+    overlap = [len(np.intersect1d(a, b)) / k for a, b in zip(reference, quantized)]
+    return float(np.mean(overlap))
@@ -1,16 +1,188 @@
+import os
+import time
 import torch
 import torch.nn as nn
 import numpy as np
 from datetime import datetime, timedelta
 import uuid
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+from id_index import IdIndex
+from service_state import bump_data_version
+from text_features import TextFeatureIndex
+from related_items import RelatedItems, interaction_matrix
+from snapshot import write_snapshot, SNAPSHOT_TOP_K
+from quantization import QuantizedModel, topk_overlap
+from suggestion_runs import start_run, publish_run, published_run_id
+from fold_in import fold_in_vector, remember
+from interaction_snapshot import InteractionTable, load_interactions, FETCH_PAGE_SIZE
+
+# 'float16' or 'int8' publishes reduced-precision model tables in each snapshot, which
+# API workers score new and folded-in users from
+INFERENCE_PRECISION = os.getenv('RECOMMENDER_INFERENCE_PRECISION', 'float32')
+# Upper bound on (user, entity) pairs scored in one forward pass
+SCORING_CHUNK_PAIRS = 2 ** 16
+# Suggestions rows written per user and entity type by the batch run
+SUGGESTIONS_PER_USER = 5
+
+# Per entity type training budgets in seconds, e.g. "videos=900,events=120"
+TRAINING_TIME_BUDGETS = {
+    entity_type: float(seconds)
+    for entity_type, seconds in (
+        item.split('=') for item in os.getenv('TRAINING_TIME_BUDGETS', '').split(',') if '=' in item
+    )
+}
+# Blend of related-item signals, e.g. "content=0.3,cooccurrence=0.5,embedding=0.2"; signals
+# left out keep their RelatedItems defaults
+RELATED_WEIGHTS = {
+    signal: float(weight)
+    for signal, weight in (
+        item.split('=') for item in os.getenv('RELATED_WEIGHTS', '').split(',') if '=' in item
+    )
+}
+VALIDATION_FRACTION = 0.1
+# Below this many interactions there is too little data to hold any out
+MIN_VALIDATION_PAIRS = 50
+# Users sampled for hit-rate@k each epoch
+HIT_RATE_SAMPLE = 200
+EARLY_STOPPING_PATIENCE = 3
+# Hit-rate often sits at its first value for a few epochs on large catalogues, so patience
+# only starts counting after this many
+MIN_TRAINING_EPOCHS = int(os.getenv('MIN_TRAINING_EPOCHS', '6'))
+MIN_IMPROVEMENT = 1e-3
+BATCH_SIZE = 256
+# Small interaction sets shrink the batch so an epoch still takes this many optimizer steps
+MIN_STEPS_PER_EPOCH = 32
+# Adam's default rate for single-pair steps, scaled by sqrt(batch size) for mini-batches
+BASE_LEARNING_RATE = 1e-3
+# Above 1, training runs data-parallel across this many local processes (see distributed_training)
+TRAINING_WORLD_SIZE = int(os.getenv('TRAINING_WORLD_SIZE', '1'))
+INTERACTION_TABLES = {
+    'videos': 'video_interactions',
+    'events': 'event_participants',
+    'projects': 'project_members'
+}
+
+def train_epoch(model, optimizer, pairs, entity_count, rng, batch_size=BATCH_SIZE):
+    # Each observed (user, entity) pair is paired with one uniformly sampled negative entity
+    loss_function = nn.BCELoss()
+    total_loss = 0.0
+    order = rng.permutation(len(pairs))
+    for start in range(0, len(order), batch_size):
+        batch = pairs[order[start:start + batch_size]]
+        negatives = rng.integers(0, entity_count, len(batch))
+        user_positions = torch.from_numpy(np.concatenate([batch[:, 0], batch[:, 0]]))
+        entity_positions = torch.from_numpy(np.concatenate([batch[:, 1], negatives]))
+        user_preference = torch.cat([torch.ones(len(batch)), torch.zeros(len(batch))]).unsqueeze(1)
+        
+        optimizer.zero_grad()
+        prediction = model(user_positions, entity_positions)
+        loss = loss_function(prediction, user_preference)
+        loss.backward()
+        optimizer.step()
+        total_loss += loss.item() * len(batch)
+    return total_loss / max(len(pairs), 1)
+
+def batch_settings(pair_count):
+    # (batch size, learning rate) for an epoch over pair_count interactions
+    batch_size = int(min(BATCH_SIZE, max(1, np.ceil(pair_count / MIN_STEPS_PER_EPOCH))))
+    return batch_size, BASE_LEARNING_RATE * np.sqrt(batch_size)
+
+def score_model(model, user_positions, entity_count):
+    user_positions = torch.as_tensor(np.asarray(user_positions, dtype=np.int64))
+    with torch.no_grad():
+        scores = model(
+            user_positions.repeat_interleave(entity_count),
+            torch.arange(entity_count).repeat(len(user_positions))
+        )
+    return scores.view(len(user_positions), entity_count).numpy()
+
+def score_model_vectors(model, user_vectors):
+    # Scores user vectors that have no row in the embedding table (folded-in users)
+    users = torch.as_tensor(np.asarray(user_vectors, dtype=np.float32))
+    entities = model.entity_features.weight
+    with torch.no_grad():
+        scores = model.recommendation_network(torch.cat([
+            users.repeat_interleave(len(entities), dim=0),
+            entities.repeat(len(users), 1)
+        ], dim=1))
+    return scores.view(len(users), len(entities)).numpy()
+
+def evaluate_model(model, validation_pairs, training_pairs, user_count, entity_count, max_recommendations=5):
+    rng = np.random.default_rng(1)
+    
+    with torch.no_grad():
+        negatives = rng.integers(0, entity_count, len(validation_pairs))
+        prediction = model(
+            torch.from_numpy(np.concatenate([validation_pairs[:, 0], validation_pairs[:, 0]])),
+            torch.from_numpy(np.concatenate([validation_pairs[:, 1], negatives]))
+        )
+        labels = torch.cat([torch.ones(len(validation_pairs)), torch.zeros(len(validation_pairs))]).unsqueeze(1)
+        validation_loss = nn.BCELoss()(prediction, labels).item()
+        
+    # Share of held-out interactions ranked in the user's top-k, ignoring items trained on
+    users = np.unique(validation_pairs[:, 0])
+    users = users[rng.permutation(len(users))[:HIT_RATE_SAMPLE]]
+    seen = interaction_matrix(training_pairs[:, 0], training_pairs[:, 1], user_count, entity_count)
+    held_out = interaction_matrix(validation_pairs[:, 0], validation_pairs[:, 1], user_count, entity_count)
+    hits = 0
+    total = 0
+    chunk_size = max(1, SCORING_CHUNK_PAIRS // entity_count)
+    k = min(max_recommendations, entity_count)
+    for start in range(0, len(users), chunk_size):
+        chunk = users[start:start + chunk_size]
+        scores = score_model(model, chunk, entity_count)
+        scores[seen[chunk].toarray() > 0] = -np.inf
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        expected = held_out[chunk]
+        hits += int(np.take_along_axis(expected.toarray(), top, axis=1).sum())
+        total += expected.nnz
+        
+    return {
+        'validation_loss': round(validation_loss, 5),
+        'hit_rate': round(hits / max(total, 1), 5)
+    }
+
+class EarlyStopping:
+    def __init__(self, patience=EARLY_STOPPING_PATIENCE, min_improvement=MIN_IMPROVEMENT,
+                 min_epochs=MIN_TRAINING_EPOCHS):
+        self.patience = patience
+        self.min_improvement = min_improvement
+        self.min_epochs = min_epochs
+        self.best_hit_rate = None
+        self.best_loss = None
+        self.best_state = None
+        self.stale_epochs = 0
+        self.epochs = 0
+        
+    def improved(self, record):
+        if self.best_hit_rate is None or record['hit_rate'] > self.best_hit_rate + self.min_improvement:
+            return True
+        # Equal hit-rate: the lower validation loss wins
+        return (record['hit_rate'] >= self.best_hit_rate - self.min_improvement
+                and record['validation_loss'] < self.best_loss - self.min_improvement)
+        
+    def update(self, model, record):
+        # Returns True once neither hit-rate nor loss has improved for `patience` epochs,
+        # never before min_epochs
+        self.epochs += 1
+        if self.improved(record):
+            self.best_hit_rate = max(record['hit_rate'], self.best_hit_rate or 0)
+            self.best_loss = record['validation_loss']
+            self.best_state = {name: value.clone() for name, value in model.state_dict().items()}
+            self.stale_epochs = 0
+            return False
+        self.stale_epochs += 1
+        return self.stale_epochs >= self.patience and self.epochs >= self.min_epochs
+        
+    def restore(self, model):
+        if self.best_state is not None:
+            model.load_state_dict(self.best_state)
 
 class RecommendationModel(nn.Module):
-    def __init__(self, total_users, total_entities, feature_size=64):
+    def __init__(self, total_users, total_entities, feature_size=64, sparse=False):
         super(RecommendationModel, self).__init__()
-        self.user_features = nn.Embedding(total_users, feature_size)
-        self.entity_features = nn.Embedding(total_entities, feature_size)
+        # Sparse embedding gradients only touch the rows in the batch (used by distributed training)
+        self.user_features = nn.Embedding(total_users, feature_size, sparse=sparse)
+        self.entity_features = nn.Embedding(total_entities, feature_size, sparse=sparse)
         self.recommendation_network = nn.Sequential(
             nn.Linear(feature_size * 2, 128),
             nn.ReLU(),
@@ -27,151 +199,355 @@ class RecommendationModel(nn.Module):
         return self.recommendation_network(combined_features)
 
 class ContentRecommender:
-    def __init__(self, database_client):
+    def __init__(self, database_client, related_weights=None):
         self.database = database_client
         self.models = {}
-        self.user_to_index = {}
-        self.index_to_user = {}
+        # Packed id <-> position maps, reverse lookups go through IdIndex.id_at/ids_at
+        self.user_to_index = IdIndex.from_ids([])
         self.entity_to_index = {}
-        self.index_to_entity = {}
         self.similar_entities = {}
+        # Precomputed top-k related items blending text, co-interaction and embedding similarity
+        self.related_items = {}
+        self.related_weights = RELATED_WEIGHTS if related_weights is None else related_weights
+        # Titles and descriptions aligned with entity positions, published in snapshots
+        self.entity_details = {}
+        self.quantized_models = {}
+        self.quantization_report = {}
+        # Set while a batch run writes suggestions, see suggestion_runs
+        self.run_id = None
+        self.published_run = None
+        # Per-epoch timing, losses and hit-rate of the last training run per entity type
+        self.training_history = {}
+        # Use the models trained by a multi-host torchrun job instead of training here
+        self.checkpoint_models = False
+        # (vector, consumed entity positions) of users folded in since training, per entity type
+        self.folded_users = {}
+        # (IdIndex of creators, creator code per entity position or -1), for excluding blocked creators
+        self.entity_creators = {}
+        # Per entity type CSR (users x entities) of items never to recommend to a user
+        self.exclusions = {}
         
     def load_user_data(self):
-        video_interactions = self.database.table('video_interactions').select('*').execute()
-        event_participants = self.database.table('event_participants').select('*').execute()
-        project_members = self.database.table('project_members').select('*').execute()
+        # Shared with the analytics run of the same refresh cycle, see interaction_snapshot
+        interactions = load_interactions(self.database)
         
-        unique_users = set()
-        
-        for interaction in video_interactions.data:
-            unique_users.add(interaction['user_id'])
-            
-        for participant in event_participants.data:
-            unique_users.add(participant['user_id'])
-            
-        for member in project_members.data:
-            unique_users.add(member['user_id'])
-        
-        for position, user_id in enumerate(unique_users):
-            self.user_to_index[user_id] = position
-            self.index_to_user[position] = user_id
+        self.user_to_index = IdIndex.union(table.users for table in interactions.values())
             
         self.load_entity_data('videos')
         self.load_entity_data('events')
         self.load_entity_data('projects')
+        self.build_exclusions(interactions)
         
-        return {
-            'video_interactions': video_interactions.data,
-            'event_participants': event_participants.data,
-            'project_members': project_members.data
-        }
+        return interactions
         
     def load_entity_data(self, entity_type):
-        self.entity_to_index[entity_type] = {}
-        self.index_to_entity[entity_type] = {}
         entities = self.database.table(entity_type).select('*').execute()
         
-        for position, entity in enumerate(entities.data):
-            self.entity_to_index[entity_type][entity['id']] = position
-            self.index_to_entity[entity_type][position] = entity['id']
+        self.entity_to_index[entity_type] = IdIndex.from_ids(entity['id'] for entity in entities.data)
+        
+        titles = [''] * len(self.entity_to_index[entity_type])
+        descriptions = [''] * len(self.entity_to_index[entity_type])
+        creators = [''] * len(self.entity_to_index[entity_type])
+        positions = self.entity_to_index[entity_type].lookup([entity['id'] for entity in entities.data])
+        for position, entity in zip(positions, entities.data):
+            titles[position] = entity.get('title') or ''
+            descriptions[position] = entity.get('description') or ''
+            creators[position] = entity.get('user_id') or ''
+        self.entity_details[entity_type] = {'title': titles, 'description': descriptions}
+        creator_index = IdIndex.from_ids(creator for creator in creators if creator)
+        self.entity_creators[entity_type] = (creator_index, creator_index.lookup(creators).astype(np.int32))
             
         self.find_similar_entities(entities.data, entity_type)
         
     def find_similar_entities(self, entities, entity_type):
-        self.similar_entities[entity_type] = {}
-        if not entities:
-            return
+        # Cached term counts and similarities are patched for new or edited entities only
+        text_index = TextFeatureIndex.load(entity_type)
+        if text_index.update(entities):
+            text_index.save()
+        self.similar_entities[entity_type] = text_index
+        
+    def interaction_positions(self, interactions, entity_type):
+        # Plain lists of rows are accepted too
+        if not isinstance(interactions, InteractionTable):
+            interactions = InteractionTable.from_rows(INTERACTION_TABLES[entity_type], interactions)
+        user_positions = interactions.user_positions(self.user_to_index)
+        entity_positions = interactions.entity_positions(self.entity_to_index[entity_type])
+        known = (user_positions >= 0) & (entity_positions >= 0)
+        return user_positions[known], entity_positions[known]
+        
+    def build_exclusions(self, interactions):
+        # Everything a user already interacted with, plus everything created by users they
+        # blocked: consumed | (blocker x creator) @ (creator x entity), all sparse
+        blocked = []
+        while True:
+            page = self.database.table('user_blocked').select('id,blocker_id,blocked_id')\
+                .order('id')\
+                .range(len(blocked), len(blocked) + FETCH_PAGE_SIZE - 1)\
+                .execute().data
+            blocked.extend(page)
+            if len(page) < FETCH_PAGE_SIZE:
+                break
+        creators = IdIndex.union(creator_index for creator_index, _ in self.entity_creators.values())
+        blocker_positions = self.user_to_index.lookup([row['blocker_id'] for row in blocked])
+        blocked_positions = creators.lookup([row['blocked_id'] for row in blocked])
+        known = (blocker_positions >= 0) & (blocked_positions >= 0)
+        blocks = interaction_matrix(
+            blocker_positions[known], blocked_positions[known], len(self.user_to_index), len(creators)
+        )
+        
+        for entity_type, table in INTERACTION_TABLES.items():
+            entity_count = len(self.entity_to_index[entity_type])
+            creator_index, creator_codes = self.entity_creators[entity_type]
+            creator_positions = np.where(creator_codes >= 0, creators.lookup_index(creator_index)[creator_codes], -1)
+            authored = np.flatnonzero(creator_positions >= 0)
+            authorship = interaction_matrix(creator_positions[authored], authored, len(creators), entity_count)
+            user_positions, entity_positions = self.interaction_positions(interactions[table], entity_type)
+            exclusions = interaction_matrix(user_positions, entity_positions, len(self.user_to_index), entity_count)
+            exclusions = (exclusions + blocks @ authorship).tocsr()
+            exclusions.data[:] = 1
+            self.exclusions[entity_type] = exclusions
             
-        entity_texts = []
-        entity_ids = []
+    def training_pairs(self, interactions, entity_type):
+        # Hold out a fixed share of interactions to measure loss and hit-rate@k on
+        pairs = np.unique(np.stack(self.interaction_positions(interactions, entity_type), axis=1), axis=0)
+        pairs = pairs[np.random.default_rng(0).permutation(len(pairs))]
+        validation_count = int(len(pairs) * VALIDATION_FRACTION) if len(pairs) >= MIN_VALIDATION_PAIRS else 0
+        return pairs[validation_count:], pairs[:validation_count]
         
-        for entity in entities:
-            title = entity.get('title', '')
-            description = entity.get('description', '')
+    def train_recommender(self, interactions, entity_type, training_rounds=10, time_budget=None,
+                          max_recommendations=5):
+        if len(self.user_to_index) == 0 or len(self.entity_to_index.get(entity_type, {})) == 0:
+            return
             
-            if title or description:
-                entity_texts.append(f"{title} {description}".strip())
-                entity_ids.append(entity['id'])
-                
-        if not entity_texts:
+        if self.checkpoint_models:
+            from distributed_training import load_prepared_checkpoint
+            self.models[entity_type], self.training_history[entity_type] = load_prepared_checkpoint(
+                entity_type, self.user_to_index, self.entity_to_index[entity_type]
+            )
             return
             
-        text_analyzer = TfidfVectorizer()
-        text_vectors = text_analyzer.fit_transform(entity_texts)
-        similarity_scores = cosine_similarity(text_vectors)
+        if time_budget is None:
+            time_budget = TRAINING_TIME_BUDGETS.get(entity_type)
+        training_pairs, validation_pairs = self.training_pairs(interactions, entity_type)
+        user_count = len(self.user_to_index)
+        entity_count = len(self.entity_to_index[entity_type])
         
-        for i, entity_id in enumerate(entity_ids):
-            self.similar_entities[entity_type][entity_id] = {
-                entity_ids[j]: score 
-                for j, score in enumerate(similarity_scores[i])
-                if i != j and score > 0.2
+        if TRAINING_WORLD_SIZE > 1:
+            from distributed_training import train_distributed
+            self.models[entity_type], self.training_history[entity_type] = train_distributed(
+                entity_type, training_pairs, validation_pairs, user_count, entity_count,
+                training_rounds, time_budget, max_recommendations, TRAINING_WORLD_SIZE
+            )
+            return
+            
+        model = RecommendationModel(user_count, entity_count)
+        self.models[entity_type] = model
+        batch_size, learning_rate = batch_settings(len(training_pairs))
+        optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
+        rng = np.random.default_rng(0)
+        early_stopping = EarlyStopping()
+        history = []
+        started_at = time.monotonic()
+        
+        for epoch in range(training_rounds):
+            epoch_started_at = time.monotonic()
+            record = {
+                'epoch': epoch + 1,
+                'train_loss': train_epoch(model, optimizer, training_pairs, entity_count, rng, batch_size)
             }
+            if len(validation_pairs):
+                record.update(evaluate_model(
+                    model, validation_pairs, training_pairs, user_count, entity_count, max_recommendations
+                ))
+            record['seconds'] = round(time.monotonic() - epoch_started_at, 3)
+            history.append(record)
+            
+            if len(validation_pairs) and early_stopping.update(model, record):
+                break
+            # Stop when another epoch like the last one would overrun the budget
+            if time_budget and time.monotonic() - started_at + record['seconds'] > time_budget:
+                break
+                
+        early_stopping.restore(model)
+        self.training_history[entity_type] = history
         
-    def train_recommender(self, interactions, entity_type, training_rounds=10):
-        if len(self.user_to_index) == 0 or len(self.entity_to_index.get(entity_type, {})) == 0:
-            return
+    def has_model(self, entity_type):
+        return entity_type in self.models or entity_type in self.quantized_models
+        
+    def measure_quantization(self, entity_type, precision=INFERENCE_PRECISION, sample_users=1000):
+        # The snapshot publishes the tables at this precision, see write_snapshot
+        if entity_type not in self.models:
+            return None
             
-        self.models[entity_type] = RecommendationModel(
-            len(self.user_to_index), 
-            len(self.entity_to_index[entity_type])
+        model = self.models[entity_type]
+        quantized = QuantizedModel.from_model(model, precision)
+        
+        # Accuracy check against the float32 model on a fixed sample of users
+        sample = np.arange(min(sample_users, len(self.user_to_index)))
+        float32_bytes = sum(parameter.numel() * 4 for parameter in model.parameters())
+        return {
+            'precision': precision,
+            'float32_bytes': float32_bytes,
+            'quantized_bytes': quantized.nbytes(),
+            'top5_overlap': topk_overlap(self.score_users(sample, entity_type), quantized.score_users(sample))
+        }
+        
+    def attach_snapshot(self, snapshot):
+        # Read-only view over a published snapshot, nothing is copied out of the mapped files
+        self.user_to_index = snapshot.users
+        self.entity_to_index = dict(snapshot.entities)
+        self.quantized_models = dict(snapshot.models)
+        self.entity_creators = dict(snapshot.creators)
+        # Shared by every request on this snapshot, so a user is only folded in once per version
+        self.folded_users = snapshot.folded_users
+        
+    def score_users(self, user_positions, entity_type):
+        if entity_type in self.quantized_models:
+            return self.quantized_models[entity_type].score_users(user_positions)
+            
+        return score_model(self.models[entity_type], user_positions, len(self.entity_to_index[entity_type]))
+        
+    def score_vectors(self, user_vectors, entity_type):
+        if entity_type in self.quantized_models:
+            return self.quantized_models[entity_type].score_vectors(user_vectors)
+            
+        return score_model_vectors(self.models[entity_type], user_vectors)
+        
+    def top_recommendations(self, entity_type, max_recommendations=5):
+        user_count = len(self.user_to_index)
+        entity_count = len(self.entity_to_index.get(entity_type, []))
+        chunk_size = max(1, SCORING_CHUNK_PAIRS // max(entity_count, 1))
+        top_k = min(max_recommendations, entity_count)
+        top_positions = np.full((user_count, top_k), -1, dtype=np.int32)
+        top_scores = np.zeros((user_count, top_k), dtype=np.float32)
+        if not self.has_model(entity_type) or top_k == 0:
+            return top_positions, top_scores
+            
+        for start in range(0, user_count, chunk_size):
+            stop = min(start + chunk_size, user_count)
+            scores = self.score_users(np.arange(start, stop), entity_type)
+            if entity_type in self.exclusions:
+                excluded = self.exclusions[entity_type][start:stop].tocoo()
+                scores[excluded.row, excluded.col] = -np.inf
+            best = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+            best_scores = np.take_along_axis(scores, best, axis=1)
+            order = np.argsort(-best_scores, axis=1, kind='stable')
+            best = np.take_along_axis(best, order, axis=1)
+            best_scores = np.take_along_axis(best_scores, order, axis=1)
+            # Users with fewer than top_k candidates left get -1 padding
+            candidate = np.isfinite(best_scores)
+            top_positions[start:stop] = np.where(candidate, best, -1)
+            top_scores[start:stop] = np.where(candidate, best_scores, 0)
+        return top_positions, top_scores
+        
+    def fold_in_user(self, user_id, entity_type):
+        # (vector, excluded entity positions) for a user missing from the trained model. Their
+        # interactions are read on every call and the vector is fitted again once they change.
+        interactions = self.database.table(INTERACTION_TABLES[entity_type]).select('*')\
+            .eq('user_id', user_id)\
+            .execute().data
+        entity_id_key = f"{entity_type[:-1]}_id"
+        entity_positions = self.entity_to_index[entity_type].lookup(
+            [interaction[entity_id_key] for interaction in interactions if entity_id_key in interaction]
         )
-        optimizer = torch.optim.Adam(self.models[entity_type].parameters())
-        loss_function = nn.BCELoss()
-        
-        for round in range(training_rounds):
-            for interaction in interactions:
-                if interaction['user_id'] not in self.user_to_index:
-                    continue
-                    
-                entity_id_key = f"{entity_type[:-1]}_id"
-                if entity_id_key not in interaction:
-                    continue
-                    
-                entity_id = interaction[entity_id_key]
-                if entity_id not in self.entity_to_index[entity_type]:
-                    continue
-                    
-                user_position = torch.tensor([self.user_to_index[interaction['user_id']]])
-                entity_position = torch.tensor([self.entity_to_index[entity_type][entity_id]])
-                user_preference = torch.tensor([[1.0]])
-                
-                optimizer.zero_grad()
-                prediction = self.models[entity_type](user_position, entity_position)
-                loss = loss_function(prediction, user_preference)
-                loss.backward()
-                optimizer.step()
-                
+        entity_positions = np.unique(entity_positions[entity_positions >= 0])
+        if len(entity_positions) == 0:
+            return None
+            
+        folded_users = self.folded_users.setdefault(entity_type, {})
+        folded = folded_users.get(user_id)
+        if folded is None or not np.array_equal(folded[1], entity_positions):
+            if entity_type in self.quantized_models:
+                model = self.quantized_models[entity_type]
+            else:
+                model = self.models[entity_type]
+            vector = fold_in_vector(model, entity_positions, len(self.entity_to_index[entity_type]))
+            folded = remember(folded_users, user_id, (vector, entity_positions))
+        vector, consumed = folded
+        return vector, np.union1d(consumed, self.blocked_entity_positions(user_id, entity_type))
+        
+    def blocked_entity_positions(self, user_id, entity_type):
+        # Entities created by users this user blocked, for users outside the exclusion matrix
+        blocked = self.database.table('user_blocked').select('blocked_id')\
+            .eq('blocker_id', user_id)\
+            .execute().data
+        if not blocked or entity_type not in self.entity_creators:
+            return np.zeros(0, dtype=np.int64)
+        creator_index, creator_codes = self.entity_creators[entity_type]
+        blocked_codes = creator_index.lookup([row['blocked_id'] for row in blocked])
+        return np.flatnonzero(np.isin(creator_codes, blocked_codes[blocked_codes >= 0]))
+        
     def get_user_recommendations(self, user_id, entity_type, max_recommendations=5):
-        if user_id not in self.user_to_index or entity_type not in self.models:
+        if not self.has_model(entity_type):
             return []
             
-        user_position = self.user_to_index[user_id]
-        recommendations = []
+        if user_id not in self.user_to_index:
+            folded = self.fold_in_user(user_id, entity_type)
+            if folded is None:
+                return []
+            vector, excluded = folded
+            preference_scores = self.score_vectors(vector[None, :], entity_type)[0]
+        else:
+            user_position = self.user_to_index[user_id]
+            preference_scores = self.score_users([user_position], entity_type)[0]
+            excluded = self.exclusions[entity_type][user_position].indices if entity_type in self.exclusions else []
+        preference_scores[excluded] = -np.inf
+        best_positions = np.argsort(-preference_scores, kind='stable')[:max_recommendations]
+        best_positions = best_positions[np.isfinite(preference_scores[best_positions])]
+        return list(zip(self.entity_to_index[entity_type].ids_at(best_positions), preference_scores[best_positions].tolist()))
         
-        for entity_id, entity_position in self.entity_to_index[entity_type].items():
-            with torch.no_grad():
-                preference_score = self.models[entity_type](
-                    torch.tensor([user_position]), 
-                    torch.tensor([entity_position])
-                )
-                recommendations.append((entity_id, preference_score.item()))
-                
-        recommendations.sort(key=lambda x: x[1], reverse=True)
-        return recommendations[:max_recommendations]
+    def build_related_items(self, interactions, entity_type):
+        if entity_type not in self.entity_to_index:
+            return
+            
+        user_positions, entity_positions = self.interaction_positions(interactions, entity_type)
+        embeddings = None
+        if entity_type in self.models:
+            embeddings = self.models[entity_type].entity_features.weight.detach().numpy()
+            
+        self.related_items[entity_type] = RelatedItems.build(
+            entity_type,
+            self.entity_to_index[entity_type],
+            text_index=self.similar_entities.get(entity_type),
+            interactions=interaction_matrix(
+                user_positions, entity_positions,
+                len(self.user_to_index), len(self.entity_to_index[entity_type])
+            ),
+            embeddings=embeddings,
+            weights=self.related_weights
+        )
+        self.related_items[entity_type].save()
         
     def find_similar_entities_for(self, entity_id, entity_type, max_suggestions=5):
-        if entity_type not in self.similar_entities or entity_id not in self.similar_entities[entity_type]:
+        # Fresh instances (e.g. per API request) fall back to the last precomputed lists
+        if entity_type not in self.related_items:
+            related_items = RelatedItems.load(entity_type)
+            if related_items is not None:
+                self.related_items[entity_type] = related_items
+                
+        if entity_type in self.related_items and entity_id in self.related_items[entity_type].positions:
+            return self.related_items[entity_type].similar_to(entity_id, max_suggestions)
+            
+        if entity_type not in self.similar_entities:
             return []
             
-        similar_entities = list(self.similar_entities[entity_type][entity_id].items())
-        similar_entities.sort(key=lambda x: x[1], reverse=True)
-        return similar_entities[:max_suggestions]
+        return self.similar_entities[entity_type].similar_to(entity_id, max_suggestions)
+        
+    def suggestion_run_id(self):
+        # Batch runs write under their own run id; on-demand saves join the published run
+        if self.run_id is not None:
+            return self.run_id
+        if self.published_run is None:
+            self.published_run = published_run_id(self.database)
+        return self.published_run
         
     def save_user_recommendations(self, user_id, recommendations, entity_type):
         if not recommendations:
             return
             
-        self.database.table('suggestions').delete().eq('user_id', user_id).eq('entity_type', entity_type).execute()
+        # Rows of the previous run stay visible until this run is published, compaction removes them
+        if self.run_id is None:
+            self.database.table('suggestions').delete().eq('user_id', user_id).eq('entity_type', entity_type).execute()
         
         for entity_id, score in recommendations:
             self.database.table('suggestions').insert({
@@ -180,7 +556,8 @@ class ContentRecommender:
                 'entity_id': entity_id,
                 'entity_type': entity_type,
                 'score': float(score),
-                'expires_at': (datetime.now() + timedelta(days=7)).isoformat()
+                'expires_at': (datetime.now() + timedelta(days=7)).isoformat(),
+                'run_id': self.suggestion_run_id()
             }).execute()
             
     def save_similar_entities(self, entity_id, similar_entities, entity_type):
@@ -197,11 +574,12 @@ class ContentRecommender:
             user_id = user['id']
             
             # Delete existing similar entity suggestions for this entity type
-            self.database.table('suggestions').delete()\
-                .eq('user_id', user_id)\
-                .eq('entity_type', f'related_{entity_type[:-1]}')\
-                .eq('entity_id', entity_id)\
-                .execute()
+            if self.run_id is None:
+                self.database.table('suggestions').delete()\
+                    .eq('user_id', user_id)\
+                    .eq('entity_type', f'related_{entity_type[:-1]}')\
+                    .eq('entity_id', entity_id)\
+                    .execute()
             
             # Insert new similar entity suggestions
             for similar_id, score in similar_entities:
@@ -212,7 +590,8 @@ class ContentRecommender:
                     'entity_type': f'related_{entity_type[:-1]}',
                     'score': float(score),
                     'expires_at': (datetime.now() + timedelta(days=7)).isoformat(),
-                    'original_entity_id': entity_id  # Store the original entity ID in a custom field
+                    'original_entity_id': entity_id,  # Store the original entity ID in a custom field
+                    'run_id': self.suggestion_run_id()
                 }).execute()
             
     def generate_all_recommendations(self):
@@ -222,16 +601,39 @@ class ContentRecommender:
         self.train_recommender(user_data['event_participants'], 'events')
         self.train_recommender(user_data['project_members'], 'projects')
         
-        for user_id in self.user_to_index:
-            video_recommendations = self.get_user_recommendations(user_id, 'videos')
-            event_recommendations = self.get_user_recommendations(user_id, 'events')
-            project_recommendations = self.get_user_recommendations(user_id, 'projects')
-            
-            self.save_user_recommendations(user_id, video_recommendations, 'videos')
-            self.save_user_recommendations(user_id, event_recommendations, 'events')
-            self.save_user_recommendations(user_id, project_recommendations, 'projects')
+        self.build_related_items(user_data['video_interactions'], 'videos')
+        self.build_related_items(user_data['event_participants'], 'events')
+        self.build_related_items(user_data['project_members'], 'projects')
+        
+        if INFERENCE_PRECISION != 'float32':
+            for entity_type in ['videos', 'events', 'projects']:
+                self.quantization_report[entity_type] = self.measure_quantization(entity_type)
+                
+        # Top-k for every user in one masked, chunked pass per entity type, shared by the
+        # suggestions table (first few) and the snapshot (all of them)
+        top_recommendations = {
+            entity_type: self.top_recommendations(entity_type, SNAPSHOT_TOP_K)
+            for entity_type in ['videos', 'events', 'projects']
+        }
+        
+        self.run_id = start_run(self.database)
+        for user_position, user_id in enumerate(self.user_to_index):
+            for entity_type, (positions, scores) in top_recommendations.items():
+                positions = positions[:, :SUGGESTIONS_PER_USER]
+                scores = scores[:, :SUGGESTIONS_PER_USER]
+                candidate = positions[user_position] >= 0
+                recommendations = list(zip(
+                    self.entity_to_index[entity_type].ids_at(positions[user_position][candidate]),
+                    scores[user_position][candidate].tolist()
+                ))
+                self.save_user_recommendations(user_id, recommendations, entity_type)
             
         for entity_type in ['videos', 'events', 'projects']:
             for entity_id in self.entity_to_index[entity_type]:
                 similar_entities = self.find_similar_entities_for(entity_id, entity_type)
-                self.save_similar_entities(entity_id, similar_entities, entity_type)
\ No newline at end of file
+                self.save_similar_entities(entity_id, similar_entities, entity_type)
+                
+        publish_run(self.database, self.run_id)
+        self.run_id = None
+        write_snapshot(self, precision=INFERENCE_PRECISION, top_recommendations=top_recommendations)
+        bump_data_version('model')
@@ -0,0 +1,119 @@
+import os
+import numpy as np
+from scipy import sparse
+from service_state import cache_path
+
+DEFAULT_WEIGHTS = {'content': 0.5, 'cooccurrence': 0.5, 'embedding': 0.0}
+TOP_K = 20
+# Upper bound on the dense (chunk x catalogue) score block held in memory at once
+CHUNK_CELLS = 2 ** 24
+
+def interaction_matrix(user_positions, entity_positions, user_count, entity_count):
+    values = np.ones(len(user_positions), dtype=np.float32)
+    matrix = sparse.csr_matrix((values, (user_positions, entity_positions)), shape=(user_count, entity_count))
+    # Repeated interactions count once
+    matrix.data[:] = 1
+    return matrix
+
+class RelatedItems:
+    def __init__(self, entity_type, ids, top_positions, top_scores):
+        self.entity_type = entity_type
+        self.ids = ids
+        self.positions = {entity_id: position for position, entity_id in enumerate(ids)}
+        self.top_positions = top_positions
+        self.top_scores = top_scores
+
+    @staticmethod
+    def path(entity_type):
+        return cache_path('related', f"{entity_type}.npz")
+
+    @classmethod
+    def build(cls, entity_type, entity_index, text_index=None, interactions=None, embeddings=None,
+              weights=None, top_k=TOP_K):
+        weights = {**DEFAULT_WEIGHTS, **(weights or {})}
+        entity_count = len(entity_index)
+        components = []
+
+        if text_index is not None and weights['content'] > 0 and len(text_index.ids):
+            # Re-key the cached text similarity from text-index rows to entity positions
+            mapping = entity_index.lookup(text_index.ids)
+            content = text_index.similarity.tocoo()
+            keep = (mapping[content.row] >= 0) & (mapping[content.col] >= 0)
+            components.append(('content', weights['content'], sparse.csr_matrix(
+                (content.data[keep], (mapping[content.row[keep]], mapping[content.col[keep]])),
+                shape=(entity_count, entity_count)
+            )))
+
+        if interactions is not None and weights['cooccurrence'] > 0 and interactions.nnz:
+            # Cosine-normalised co-occurrence: users in common over sqrt(degree_i * degree_j)
+            degree = np.asarray(interactions.sum(axis=0)).ravel()
+            scale = sparse.diags(1 / np.sqrt(np.maximum(degree, 1)).astype(np.float32))
+            normalised = (interactions @ scale).tocsc()
+            components.append(('cooccurrence', weights['cooccurrence'], normalised))
+
+        if embeddings is not None and weights['embedding'] > 0:
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            embeddings = (embeddings / np.maximum(norms, 1e-12)).astype(np.float32)
+        else:
+            embeddings = None
+
+        top_k = min(top_k, max(entity_count - 1, 0))
+        top_positions = np.full((entity_count, top_k), -1, dtype=np.int32)
+        top_scores = np.zeros((entity_count, top_k), dtype=np.float32)
+        chunk_size = max(1, CHUNK_CELLS // max(entity_count, 1))
+
+        for start in range(0, entity_count if top_k else 0, chunk_size):
+            stop = min(start + chunk_size, entity_count)
+            scores = np.zeros((stop - start, entity_count), dtype=np.float32)
+            for kind, weight, matrix in components:
+                if kind == 'content':
+                    block = matrix[start:stop]
+                else:
+                    # Item-item product over users, one column chunk at a time
+                    block = matrix[:, start:stop].T @ matrix
+                scores += weight * block.toarray()
+            if embeddings is not None:
+                scores += weights['embedding'] * np.maximum(embeddings[start:stop] @ embeddings.T, 0)
+
+            scores[np.arange(stop - start), np.arange(start, stop)] = 0
+            best = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+            best_scores = np.take_along_axis(scores, best, axis=1)
+            order = np.argsort(-best_scores, axis=1, kind='stable')
+            best = np.take_along_axis(best, order, axis=1)
+            best_scores = np.take_along_axis(best_scores, order, axis=1)
+            top_positions[start:stop] = np.where(best_scores > 0, best, -1)
+            top_scores[start:stop] = np.where(best_scores > 0, best_scores, 0)
+
+        return cls(entity_type, list(entity_index), top_positions, top_scores)
+
+    @classmethod
+    def load(cls, entity_type):
+        path = cls.path(entity_type)
+        if not os.path.exists(path):
+            return None
+
+        with np.load(path, allow_pickle=False) as stored:
+            return cls(entity_type, stored['ids'].tolist(), stored['top_positions'], stored['top_scores'])
+
+    def save(self):
+        path = self.path(self.entity_type)
+        with open(f"{path}.tmp", 'wb') as stored:
+            np.savez(
+                stored,
+                ids=np.array(self.ids, dtype=str),
+                top_positions=self.top_positions,
+                top_scores=self.top_scores
+            )
+        os.replace(f"{path}.tmp", path)
+
+    def similar_to(self, entity_id, max_suggestions=5):
+        position = self.positions.get(entity_id)
+        if position is None:
+            return []
+
+        related = []
+        for related_position, score in zip(self.top_positions[position], self.top_scores[position]):
+            if related_position < 0 or len(related) >= max_suggestions:
+                break
+            related.append((self.ids[related_position], float(score)))
+        return related
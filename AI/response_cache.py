@@ -0,0 +1,63 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response
+
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '2048'))
+RESPONSE_CACHE_MAX_AGE = int(os.getenv('RESPONSE_CACHE_MAX_AGE', '300'))
+
+# Bounded LRU of rendered JSON bodies keyed by route and parameters. Entries remember the
+# data version they were rendered from and are dropped once that version is replaced.
+class ResponseCache:
+    def __init__(self, max_entries=RESPONSE_CACHE_SIZE, max_age=RESPONSE_CACHE_MAX_AGE):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry['version'] != version:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def render(self, version, content):
+        body = json.dumps(jsonable_encoder(content), separators=(',', ':')).encode('utf-8')
+        return {
+            'version': version,
+            'body': body,
+            'etag': f'"{hashlib.sha1(version.encode("utf-8") + body).hexdigest()}"'
+        }
+
+    def put(self, key, version, content):
+        entry = self.render(version, content)
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
+
+    def respond(self, request, entry, shared=True, max_age=None):
+        # Personalised responses must not be stored by a shared CDN cache
+        headers = {
+            'ETag': entry['etag'],
+            'Cache-Control': f"{'public' if shared else 'private'}, max-age={self.max_age if max_age is None else max_age}"
+        }
+        if _etag_matches(request.headers.get('if-none-match'), entry['etag']):
+            return Response(status_code=304, headers=headers)
+        return Response(content=entry['body'], media_type=JSONResponse.media_type, headers=headers)
+
+def _etag_matches(header, etag):
+    if not header:
+        return False
+    candidates = [candidate.strip() for candidate in header.split(',')]
+    return '*' in candidates or etag in candidates or f"W/{etag}" in candidates
@@ -0,0 +1,78 @@
+import json
+import os
+import uuid
+import threading
+import time
+
+# Imported first by main.py so the timestamp covers interpreter and dependency start-up
+PROCESS_STARTED_AT = time.monotonic()
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+
+_lock = threading.Lock()
+_state = {
+    'serving_since': None,
+    'cold_start_seconds': None
+}
+
+def mark_serving():
+    with _lock:
+        if _state['serving_since'] is None:
+            _state['serving_since'] = time.monotonic()
+            _state['cold_start_seconds'] = round(_state['serving_since'] - PROCESS_STARTED_AT, 3)
+
+# Refresh progress is kept in a file because the refresh runs in the supervisor process
+# while each API worker reports it from its own process
+def _write_refresh_state(state):
+    path = cache_path('state', 'initial_refresh.json')
+    with open(f"{path}.tmp", 'w') as state_file:
+        json.dump(state, state_file)
+    os.replace(f"{path}.tmp", path)
+
+def _read_refresh_state():
+    try:
+        with open(cache_path('state', 'initial_refresh.json')) as state_file:
+            return json.load(state_file)
+    except (FileNotFoundError, ValueError):
+        return {'initial_refresh': 'pending', 'initial_refresh_seconds': None, 'last_refresh_error': None}
+
+def mark_refresh_started():
+    _write_refresh_state({'initial_refresh': 'running', 'initial_refresh_seconds': None, 'last_refresh_error': None})
+
+def mark_refresh_finished(started_at, error=None):
+    _write_refresh_state({
+        'initial_refresh': 'failed' if error else 'completed',
+        'initial_refresh_seconds': round(time.monotonic() - started_at, 3),
+        'last_refresh_error': str(error) if error else None
+    })
+
+def snapshot():
+    with _lock:
+        state = dict(_state)
+    state.update(_read_refresh_state())
+    state['uptime_seconds'] = round(time.monotonic() - PROCESS_STARTED_AT, 3)
+    state['pid'] = os.getpid()
+    state.pop('serving_since')
+    return state
+
+# Models, id maps and other batch artifacts are persisted here between runs.
+# Read on every call because this module is imported before load_dotenv() runs.
+def cache_path(*parts):
+    path = os.path.join(os.getenv('RECOMMENDER_CACHE_DIR', DEFAULT_CACHE_DIR), *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+# Generation markers for published data, bumped by the batch jobs and read by the API
+# workers to invalidate anything derived from an older model or analytics run
+def bump_data_version(name):
+    path = cache_path('versions', name)
+    with open(f"{path}.tmp", 'w') as version_file:
+        version_file.write(uuid.uuid4().hex)
+    os.replace(f"{path}.tmp", path)
+
+def data_version(name):
+    try:
+        with open(cache_path('versions', name)) as version_file:
+            return version_file.read().strip()
+    except FileNotFoundError:
+        return 'initial'
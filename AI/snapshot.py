@@ -0,0 +1,203 @@
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from datetime import datetime
+import numpy as np
+from id_index import IdIndex
+from quantization import QuantizedModel
+from service_state import cache_path
+
+ENTITY_TYPES = ['videos', 'events', 'projects']
+SNAPSHOT_TOP_K = 20
+SNAPSHOTS_KEPT = 2
+# How often readers look for a newly published snapshot
+RELOAD_INTERVAL = 5
+
+# Versioned flat numpy layout written by the batch job and memory-mapped by the API:
+#
+#   snapshots/CURRENT                     name of the live version, swapped with os.replace
+#   snapshots/<version>/users.npy         IdIndex of users (sorted, binary searched)
+#   snapshots/<version>/<type>.ids.npy    IdIndex of entities
+#   <type>.recommendations / .recommendation_scores   per-user top-k entity positions
+#   <type>.related / .related_scores                  per-entity top-k entity positions
+#   <type>.title / .description (.offsets)            utf-8 bytes with row offsets
+#   <type>.creators / .creator_codes                  IdIndex of creators, creator code per entity
+#   <type>.model/                                     QuantizedModel tables for live scoring
+#
+# Every API worker maps the same files read-only, so model tables and id maps are held
+# once in the page cache however many workers are running.
+def write_snapshot(recommender, top_k=SNAPSHOT_TOP_K, precision='float32', top_recommendations=None):
+    version = f"{datetime.now().strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    directory = _version_directory(version)
+
+    recommender.user_to_index.save(os.path.join(directory, 'users'))
+    entity_types = []
+    for entity_type in ENTITY_TYPES:
+        if entity_type not in recommender.entity_to_index:
+            continue
+        entity_types.append(entity_type)
+        entity_index = recommender.entity_to_index[entity_type]
+        entity_index.save(os.path.join(directory, f"{entity_type}.ids"))
+
+        # Reuses the top-k the batch run already scored for the suggestions table
+        if top_recommendations and entity_type in top_recommendations:
+            positions, scores = top_recommendations[entity_type]
+        else:
+            positions, scores = recommender.top_recommendations(entity_type, top_k)
+        _save(directory, f"{entity_type}.recommendations", positions)
+        _save(directory, f"{entity_type}.recommendation_scores", scores)
+
+        related = recommender.related_items.get(entity_type)
+        if related is None:
+            related_positions = np.full((len(entity_index), 0), -1, dtype=np.int32)
+            related_scores = np.zeros((len(entity_index), 0), dtype=np.float32)
+        else:
+            related_positions, related_scores = related.top_positions, related.top_scores
+        _save(directory, f"{entity_type}.related", related_positions)
+        _save(directory, f"{entity_type}.related_scores", related_scores)
+
+        if entity_type in recommender.models:
+            QuantizedModel.from_model(recommender.models[entity_type], precision).save(
+                os.path.join(directory, f"{entity_type}.model")
+            )
+
+        # Folded-in users are not in the exclusion matrix, the API masks their blocked creators from this
+        if entity_type in recommender.entity_creators:
+            creator_index, creator_codes = recommender.entity_creators[entity_type]
+            creator_index.save(os.path.join(directory, f"{entity_type}.creators"))
+            _save(directory, f"{entity_type}.creator_codes", creator_codes)
+
+        details = recommender.entity_details.get(entity_type, {})
+        for field in ['title', 'description']:
+            values = details.get(field) or [''] * len(entity_index)
+            encoded = [value.encode('utf-8') for value in values]
+            offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(value) for value in encoded])
+            _save(directory, f"{entity_type}.{field}.offsets", offsets)
+            _save(directory, f"{entity_type}.{field}", np.frombuffer(b''.join(encoded), dtype=np.uint8))
+
+    with open(os.path.join(directory, 'manifest.json'), 'w') as manifest:
+        json.dump({'version': version, 'entity_types': entity_types, 'top_k': top_k,
+                   'created_at': datetime.now().isoformat()}, manifest)
+
+    # Readers only ever follow CURRENT, so the new version goes live in one rename
+    current = cache_path('snapshots', 'CURRENT')
+    with open(f"{current}.tmp", 'w') as pointer:
+        pointer.write(version)
+    os.replace(f"{current}.tmp", current)
+    _remove_old_versions(version)
+    return version
+
+def _version_directory(version):
+    # cache_path creates the parent directory of the path it is given
+    return os.path.dirname(cache_path('snapshots', version, 'manifest.json'))
+
+def _save(directory, name, array):
+    np.save(os.path.join(directory, f"{name}.npy"), np.ascontiguousarray(array))
+
+def _remove_old_versions(current_version):
+    root = os.path.dirname(cache_path('snapshots', 'CURRENT'))
+    versions = sorted(name for name in os.listdir(root) if os.path.isdir(os.path.join(root, name)))
+    # Mapped files stay readable for workers still holding an older version
+    for name in versions[:-SNAPSHOTS_KEPT]:
+        if name != current_version:
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+class Snapshot:
+    def __init__(self, directory):
+        with open(os.path.join(directory, 'manifest.json')) as manifest:
+            self.manifest = json.load(manifest)
+        self.version = self.manifest['version']
+        self.users = IdIndex.load(os.path.join(directory, 'users'))
+        self.entities = {}
+        self.models = {}
+        self.creators = {}
+        self.arrays = {}
+        # Users folded in against this version's models, see ContentRecommender.fold_in_user
+        self.folded_users = {}
+        for entity_type in self.manifest['entity_types']:
+            self.entities[entity_type] = IdIndex.load(os.path.join(directory, f"{entity_type}.ids"))
+            model_directory = os.path.join(directory, f"{entity_type}.model")
+            if os.path.exists(os.path.join(model_directory, 'manifest.json')):
+                self.models[entity_type] = QuantizedModel.load(model_directory)
+            creators_path = os.path.join(directory, f"{entity_type}.creators")
+            if os.path.exists(f"{creators_path}.json"):
+                self.creators[entity_type] = (
+                    IdIndex.load(creators_path),
+                    np.load(os.path.join(directory, f"{entity_type}.creator_codes.npy"), mmap_mode='r')
+                )
+            for name in ['recommendations', 'recommendation_scores', 'related', 'related_scores',
+                         'title', 'title.offsets', 'description', 'description.offsets']:
+                self.arrays[(entity_type, name)] = np.load(
+                    os.path.join(directory, f"{entity_type}.{name}.npy"), mmap_mode='r'
+                )
+
+    def recommendations(self, user_id, entity_type, max_recommendations=5):
+        # None means the user is not in this snapshot, so callers fall back to the database
+        position = self.users.get(user_id)
+        if position is None or entity_type not in self.entities:
+            return None
+        return self._rows(entity_type, 'recommendations', 'recommendation_scores', position, max_recommendations)
+
+    def related(self, entity_type, entity_id, max_suggestions=5):
+        if entity_type not in self.entities:
+            return None
+        position = self.entities[entity_type].get(entity_id)
+        if position is None:
+            return None
+        return self._rows(entity_type, 'related', 'related_scores', position, max_suggestions)
+
+    def details(self, entity_type, entity_ids):
+        positions = self.entities[entity_type].lookup(entity_ids)
+        return {
+            entity_id: {'title': self._text(entity_type, 'title', position),
+                        'description': self._text(entity_type, 'description', position)}
+            for entity_id, position in zip(entity_ids, positions) if position >= 0
+        }
+
+    def _rows(self, entity_type, name, scores_name, position, limit):
+        positions = self.arrays[(entity_type, name)][position][:limit]
+        scores = self.arrays[(entity_type, scores_name)][position][:limit]
+        valid = positions >= 0
+        entity_ids = self.entities[entity_type].ids_at(positions[valid])
+        return [
+            {
+                'entity_id': entity_id,
+                'entity_type': entity_type,
+                'score': float(score),
+                'title': self._text(entity_type, 'title', entity_position),
+                'description': self._text(entity_type, 'description', entity_position)
+            }
+            for entity_id, entity_position, score in zip(entity_ids, positions[valid], scores[valid])
+        ]
+
+    def _text(self, entity_type, field, position):
+        offsets = self.arrays[(entity_type, f"{field}.offsets")]
+        value = bytes(self.arrays[(entity_type, field)][offsets[position]:offsets[position + 1]]).decode('utf-8')
+        return value or None
+
+# Follows snapshots/CURRENT and swaps in the new mapping when a version is published
+class SnapshotReader:
+    def __init__(self, reload_interval=RELOAD_INTERVAL):
+        self.reload_interval = reload_interval
+        self.snapshot = None
+        self.checked_at = 0
+        self.lock = threading.Lock()
+
+    def current(self):
+        if time.monotonic() - self.checked_at < self.reload_interval:
+            return self.snapshot
+
+        with self.lock:
+            self.checked_at = time.monotonic()
+            try:
+                with open(cache_path('snapshots', 'CURRENT')) as pointer:
+                    version = pointer.read().strip()
+                if self.snapshot is None or self.snapshot.version != version:
+                    self.snapshot = Snapshot(_version_directory(version))
+            except (FileNotFoundError, OSError, ValueError, KeyError):
+                pass
+            return self.snapshot
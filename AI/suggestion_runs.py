@@ -0,0 +1,106 @@
+import os
+import time
+import uuid
+from datetime import datetime, timedelta
+
+COMPACTION_BATCH_SIZE = int(os.getenv('COMPACTION_BATCH_SIZE', '500'))
+COMPACTION_BATCHES_PER_SECOND = float(os.getenv('COMPACTION_BATCHES_PER_SECOND', '2'))
+# Runs still 'running' after this long are assumed to have crashed
+STALE_RUN_HOURS = 24
+# Run ids per `in` filter, keeps the request URL short
+RUN_IDS_PER_QUERY = 100
+
+# Every batch run writes its suggestions under a new run_id and only becomes visible once
+# it is marked 'published', so readers never see a half-written generation.
+def start_run(database):
+    run_id = str(uuid.uuid4())
+    database.table('suggestion_runs').insert({
+        'run_id': run_id,
+        'status': 'running',
+        'started_at': datetime.now().isoformat()
+    }).execute()
+    return run_id
+
+def publish_run(database, run_id):
+    database.table('suggestion_runs').update({
+        'status': 'published',
+        'completed_at': datetime.now().isoformat()
+    }).eq('run_id', run_id).execute()
+
+def published_run(database):
+    runs = database.table('suggestion_runs').select('run_id,completed_at')\
+        .eq('status', 'published')\
+        .order('completed_at', desc=True)\
+        .limit(1)\
+        .execute()
+    return runs.data[0] if runs.data else None
+
+def published_run_id(database):
+    run = published_run(database)
+    return run['run_id'] if run else None
+
+class SuggestionCompactor:
+    def __init__(self, database_client, batch_size=COMPACTION_BATCH_SIZE,
+                 batches_per_second=COMPACTION_BATCHES_PER_SECOND):
+        self.database = database_client
+        self.batch_size = batch_size
+        self.batches_per_second = batches_per_second
+
+    def compact(self):
+        started_at = time.monotonic()
+        self.fail_stale_runs()
+        published = published_run(self.database)
+
+        expired_removed = self.delete_in_batches(
+            lambda query: query.lt('expires_at', datetime.now().isoformat())
+        )
+
+        superseded_removed = 0
+        if published:
+            # Only runs published before the one read above, a run publishing while this
+            # compaction is under way is newer and must stay visible
+            self.database.table('suggestion_runs').update({'status': 'superseded'})\
+                .eq('status', 'published')\
+                .lt('completed_at', published['completed_at'])\
+                .execute()
+
+        # Only rows of runs known to be finished are removed; a run that started after this
+        # point is never in the list, however long the deletion takes
+        finished = [
+            run['run_id']
+            for run in self.database.table('suggestion_runs').select('run_id')
+                .in_('status', ['superseded', 'failed']).execute().data
+        ]
+        for start in range(0, len(finished), RUN_IDS_PER_QUERY):
+            run_ids = finished[start:start + RUN_IDS_PER_QUERY]
+            superseded_removed += self.delete_in_batches(lambda query: query.in_('run_id', run_ids))
+        if published:
+            # Untagged rows from before run ids existed
+            superseded_removed += self.delete_in_batches(lambda query: query.is_('run_id', 'null'))
+
+        return {
+            'expired_removed': expired_removed,
+            'superseded_removed': superseded_removed,
+            'seconds': round(time.monotonic() - started_at, 3)
+        }
+
+    def fail_stale_runs(self):
+        cutoff = (datetime.now() - timedelta(hours=STALE_RUN_HOURS)).isoformat()
+        self.database.table('suggestion_runs').update({'status': 'failed'})\
+            .eq('status', 'running')\
+            .lt('started_at', cutoff)\
+            .execute()
+
+    def delete_in_batches(self, condition):
+        removed = 0
+        while True:
+            rows = condition(self.database.table('suggestions').select('id'))\
+                .limit(self.batch_size)\
+                .execute().data
+            if rows:
+                self.database.table('suggestions').delete().in_('id', [row['id'] for row in rows]).execute()
+                removed += len(rows)
+            if len(rows) < self.batch_size:
+                return removed
+            # Rate limit so compaction never saturates the database
+            time.sleep(1 / self.batches_per_second)
@@ -1,17 +1,113 @@
 import unittest
 from supabase import create_client
 import os
+import json
 from dotenv import load_dotenv
-from recommendation_system import ContentRecommender
+from recommendation_system import ContentRecommender, RecommendationModel, score_model_vectors
+from related_items import interaction_matrix
+from text_features import TextFeatureIndex, SIMILARITY_THRESHOLD
 from analytics_system import AnalyticsSystem
+from id_index import IdIndex
+from quantization import QuantizedModel, quantize_table, dequantize_rows, topk_overlap
+from snapshot import SnapshotReader, write_snapshot
+from suggestion_runs import SuggestionCompactor, published_run_id
+from fold_in import fold_in_vector
+from response_cache import ResponseCache
+from ingestion import InteractionCounters
+from service_state import data_version
+import numpy as np
+import torch
 from datetime import datetime, timedelta
 import uuid
+import tempfile
+from types import SimpleNamespace
 
 load_dotenv()
 
 SUPABASE_URL = os.getenv('SUPABASE_URL')
 SUPABASE_KEY = os.getenv('SUPABASE_KEY')
 
+# In-memory stand-in for the few query builder calls the offline tests go through
+class StubQuery:
+    def __init__(self, rows):
+        self.rows = rows
+        self.conditions = []
+        self.negate = False
+        self.action = 'select'
+        self.values = None
+        self.ordering = None
+        self.count = None
+        
+    def select(self, columns):
+        return self
+        
+    def where(self, test):
+        negate, self.negate = self.negate, False
+        self.conditions.append(lambda row: test(row) != negate)
+        return self
+        
+    def eq(self, column, value):
+        return self.where(lambda row: row.get(column) == value)
+        
+    def neq(self, column, value):
+        return self.where(lambda row: row.get(column) != value)
+        
+    def lt(self, column, value):
+        return self.where(lambda row: row.get(column) is not None and row[column] < value)
+        
+    def in_(self, column, values):
+        return self.where(lambda row: row.get(column) in values)
+        
+    def is_(self, column, value):
+        return self.where(lambda row: row.get(column) is None)
+        
+    @property
+    def not_(self):
+        self.negate = True
+        return self
+        
+    def order(self, column, desc=False):
+        self.ordering = (column, desc)
+        return self
+        
+    def limit(self, count):
+        self.count = count
+        return self
+        
+    def insert(self, values):
+        self.action, self.values = 'insert', values if isinstance(values, list) else [values]
+        return self
+        
+    def update(self, values):
+        self.action, self.values = 'update', values
+        return self
+        
+    def delete(self):
+        self.action = 'delete'
+        return self
+        
+    def execute(self):
+        if self.action == 'insert':
+            self.rows.extend(dict(row) for row in self.values)
+            return SimpleNamespace(data=self.values)
+        matched = [row for row in self.rows if all(test(row) for test in self.conditions)]
+        if self.action == 'update':
+            for row in matched:
+                row.update(self.values)
+        elif self.action == 'delete':
+            self.rows[:] = [row for row in self.rows if not any(row is match for match in matched)]
+        if self.ordering:
+            column, desc = self.ordering
+            matched = sorted(matched, key=lambda row: row.get(column) or '', reverse=desc)
+        return SimpleNamespace(data=[dict(row) for row in matched[:self.count]])
+        
+class StubDatabase:
+    def __init__(self, tables):
+        self.tables = tables
+        
+    def table(self, name):
+        return StubQuery(self.tables.setdefault(name, []))
+
 class TestRecommendationSystem(unittest.TestCase):
     def setUp(self):
         self.supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
@@ -158,5 +254,346 @@ class TestRecommendationSystem(unittest.TestCase):
         self.supabase.table('projects').delete().eq('id', self.test_project_id).execute()
         self.supabase.table('users').delete().eq('id', self.test_user_id).execute()
         
+class TestIdIndex(unittest.TestCase):
+    def test_uuid_ids_are_packed_and_sorted(self):
+        ids = [str(uuid.uuid4()) for _ in range(5)]
+        index = IdIndex.from_ids(ids + ids[:2])
+        self.assertTrue(index.packed_uuids)
+        self.assertEqual(index.ids.dtype.itemsize, 16)
+        self.assertEqual(list(index), sorted(ids, key=lambda value: uuid.UUID(value).bytes))
+        positions = index.lookup(ids + [str(uuid.uuid4()), 'not-a-uuid'])
+        self.assertEqual(index.ids_at(positions[:5]), ids)
+        self.assertEqual(positions[5:].tolist(), [-1, -1])
+        
+    def test_text_ids_round_trip_through_memory_map(self):
+        index = IdIndex.from_ids(['event-b', 'event-a', 'event-c'])
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'events')
+            index.save(path)
+            loaded = IdIndex.load(path)
+            self.assertFalse(loaded.packed_uuids)
+            self.assertEqual(loaded.lookup(['event-c', 'event-a', 'missing']).tolist(), [2, 0, -1])
+            self.assertEqual(loaded.id_at(1), 'event-b')
+            self.assertIn('event-a', loaded)
+            
+class TestQuantization(unittest.TestCase):
+    def test_int8_rows_round_trip_within_one_step(self):
+        table = np.random.default_rng(0).normal(size=(50, 64)).astype(np.float32)
+        values, scales = quantize_table(table, 'int8')
+        self.assertEqual(values.dtype, np.int8)
+        restored = dequantize_rows(values, scales, np.arange(50))
+        self.assertTrue(np.all(np.abs(restored - table) <= scales[:, None] / 2 + 1e-6))
+        
+    def test_topk_overlap(self):
+        reference = np.array([[0.9, 0.8, 0.1, 0.0]])
+        self.assertEqual(topk_overlap(reference, reference, k=2), 1.0)
+        self.assertEqual(topk_overlap(reference, np.array([[0.9, 0.0, 0.8, 0.1]]), k=2), 0.5)
+        
+    def test_float32_tables_match_model_forward(self):
+        torch.manual_seed(0)
+        model = RecommendationModel(6, 9)
+        users, entities = np.meshgrid(np.arange(6), np.arange(9), indexing='ij')
+        with torch.no_grad():
+            expected = model(torch.from_numpy(users.ravel()), torch.from_numpy(entities.ravel())).numpy().reshape(6, 9)
+        quantized = QuantizedModel.from_model(model, 'float32')
+        np.testing.assert_allclose(quantized.score_users(np.arange(6)), expected, rtol=1e-5, atol=1e-6)
+        np.testing.assert_allclose(quantized.score_users(np.array([4]), np.array([2, 7])), expected[[4]][:, [2, 7]],
+                                   rtol=1e-5, atol=1e-6)
+        
+class TestExclusionMask(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.recommender = ContentRecommender(None)
+        self.recommender.user_to_index = IdIndex.from_ids(['user-a', 'user-b', 'user-c'])
+        self.recommender.entity_to_index['videos'] = IdIndex.from_ids(['video-a', 'video-b', 'video-c', 'video-d'])
+        self.recommender.models['videos'] = RecommendationModel(3, 4)
+        # user-a excluded from everything but one video, user-b from all of them
+        self.recommender.exclusions['videos'] = interaction_matrix(
+            np.array([0, 0, 0, 1, 1, 1, 1]), np.array([0, 1, 3, 0, 1, 2, 3]), 3, 4
+        )
+        
+    def test_excluded_items_are_never_ranked(self):
+        positions, scores = self.recommender.top_recommendations('videos', 3)
+        self.assertEqual(positions.shape, (3, 3))
+        self.assertEqual(positions[0].tolist(), [2, -1, -1])
+        self.assertEqual(positions[1].tolist(), [-1, -1, -1])
+        self.assertEqual(scores[1].tolist(), [0, 0, 0])
+        self.assertEqual(len(set(positions[2].tolist()) - {-1}), 3)
+        self.assertTrue(np.all(np.diff(scores[2]) <= 0))
+        
+    def test_single_user_matches_batch_scoring(self):
+        positions, _ = self.recommender.top_recommendations('videos', 4)
+        for user_id in ['user-a', 'user-b', 'user-c']:
+            user_position = self.recommender.user_to_index[user_id]
+            expected = positions[user_position][positions[user_position] >= 0]
+            recommendations = self.recommender.get_user_recommendations(user_id, 'videos', 4)
+            self.assertEqual([entity_id for entity_id, _ in recommendations],
+                             self.recommender.entity_to_index['videos'].ids_at(expected))
+            
+class TestSnapshotExclusions(unittest.TestCase):
+    def setUp(self):
+        self.cache = tempfile.TemporaryDirectory()
+        self.previous_cache = os.environ.get('RECOMMENDER_CACHE_DIR')
+        os.environ['RECOMMENDER_CACHE_DIR'] = self.cache.name
+        
+        torch.manual_seed(0)
+        videos = ['video-a', 'video-b', 'video-c', 'video-d', 'video-e', 'video-f']
+        creators = ['creator-x', 'creator-x', 'creator-y', 'creator-y', '', 'creator-y']
+        batch = ContentRecommender(None)
+        batch.user_to_index = IdIndex.from_ids(['user-a', 'user-b'])
+        batch.entity_to_index['videos'] = IdIndex.from_ids(videos)
+        batch.models['videos'] = RecommendationModel(2, len(videos))
+        creator_index = IdIndex.from_ids(['creator-x', 'creator-y'])
+        batch.entity_creators['videos'] = (creator_index, creator_index.lookup(creators).astype(np.int32))
+        write_snapshot(batch)
+        
+    def tearDown(self):
+        if self.previous_cache is None:
+            os.environ.pop('RECOMMENDER_CACHE_DIR')
+        else:
+            os.environ['RECOMMENDER_CACHE_DIR'] = self.previous_cache
+        self.cache.cleanup()
+        
+    def test_folded_in_user_skips_blocked_creators(self):
+        # Built the way the API builds its live recommender
+        database = StubDatabase({
+            'video_interactions': [{'user_id': 'new-user', 'video_id': 'video-c'}],
+            'user_blocked': [{'blocker_id': 'new-user', 'blocked_id': 'creator-x'}]
+        })
+        recommender = ContentRecommender(database)
+        recommender.attach_snapshot(SnapshotReader().current())
+        recommendations = [entity_id for entity_id, _ in recommender.get_user_recommendations('new-user', 'videos', 6)]
+        self.assertEqual(sorted(recommendations), ['video-d', 'video-e', 'video-f'])
+        
+class TestFoldIn(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.model = RecommendationModel(4, 8)
+        self.database = StubDatabase({'video_interactions': []})
+        self.recommender = ContentRecommender(self.database)
+        self.recommender.user_to_index = IdIndex.from_ids(['user-a', 'user-b', 'user-c', 'user-d'])
+        self.recommender.entity_to_index['videos'] = IdIndex.from_ids([f'video-{i}' for i in range(8)])
+        self.recommender.models['videos'] = self.model
+        
+    def test_fold_in_vector_raises_scores_of_interacted_entities(self):
+        prior = self.model.user_features.weight.detach().numpy().mean(axis=0)
+        vector = fold_in_vector(self.model, [1, 2], 8, rng=np.random.default_rng(0))
+        before = score_model_vectors(self.model, prior[None, :])[0]
+        after = score_model_vectors(self.model, vector[None, :])[0]
+        self.assertEqual(vector.shape, prior.shape)
+        self.assertGreater(after[[1, 2]].mean() - after.mean(), before[[1, 2]].mean() - before.mean())
+        
+    def test_unknown_user_follows_their_interactions(self):
+        self.assertEqual(self.recommender.get_user_recommendations('new-user', 'videos', 8), [])
+        
+        self.database.tables['video_interactions'].append({'user_id': 'new-user', 'video_id': 'video-3'})
+        first = [entity_id for entity_id, _ in self.recommender.get_user_recommendations('new-user', 'videos', 8)]
+        self.assertEqual(len(first), 7)
+        self.assertNotIn('video-3', first)
+        vector = self.recommender.folded_users['videos']['new-user'][0]
+        
+        self.database.tables['video_interactions'].append({'user_id': 'new-user', 'video_id': first[0]})
+        second = [entity_id for entity_id, _ in self.recommender.get_user_recommendations('new-user', 'videos', 8)]
+        self.assertEqual(len(second), 6)
+        self.assertNotIn(first[0], second)
+        self.assertFalse(np.array_equal(vector, self.recommender.folded_users['videos']['new-user'][0]))
+        
+class TestResponseCache(unittest.TestCase):
+    def request(self, if_none_match=None):
+        return SimpleNamespace(headers={'if-none-match': if_none_match} if if_none_match else {})
+        
+    def test_matching_or_weak_etag_gets_not_modified(self):
+        cache = ResponseCache(max_entries=4, max_age=60)
+        entry = cache.put(('related', 'videos', 'video-a'), '1', [{'entity_id': 'video-b'}])
+        self.assertEqual(cache.respond(self.request(entry['etag']), entry).status_code, 304)
+        self.assertEqual(cache.respond(self.request(f"W/{entry['etag']}"), entry).status_code, 304)
+        self.assertEqual(cache.respond(self.request(f'"other", {entry["etag"]}'), entry).status_code, 304)
+        
+        response = cache.respond(self.request('"other"'), entry, shared=False)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.body), [{'entity_id': 'video-b'}])
+        self.assertEqual(response.headers['etag'], entry['etag'])
+        self.assertEqual(response.headers['cache-control'], 'private, max-age=60')
+        
+    def test_entry_is_dropped_when_version_changes(self):
+        cache = ResponseCache(max_entries=4)
+        first = cache.put('key', '1', {'value': 1})
+        self.assertIs(cache.get('key', '1'), first)
+        self.assertIsNone(cache.get('key', '2'))
+        self.assertIsNone(cache.get('key', '1'))
+        self.assertNotEqual(cache.put('key', '2', {'value': 1})['etag'], first['etag'])
+        
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = ResponseCache(max_entries=2)
+        cache.put('a', '1', 'a')
+        cache.put('b', '1', 'b')
+        cache.get('a', '1')
+        cache.put('c', '1', 'c')
+        self.assertIsNotNone(cache.get('a', '1'))
+        self.assertIsNone(cache.get('b', '1'))
+        self.assertIsNotNone(cache.get('c', '1'))
+        self.assertEqual(len(cache.entries), 2)
+        
+class FlakyDatabase(StubDatabase):
+    # Raises on the given insert calls, counted from 1
+    def __init__(self, failing_inserts):
+        super().__init__({'status': []})
+        self.failing_inserts = failing_inserts
+        self.inserts = 0
+        
+    def table(self, name):
+        query = super().table(name)
+        insert = query.insert
+        
+        def counted_insert(values):
+            self.inserts += 1
+            if self.inserts in self.failing_inserts:
+                raise ConnectionError('insert failed')
+            return insert(values)
+            
+        query.insert = counted_insert
+        return query
+        
+class TestInteractionCounters(unittest.TestCase):
+    def setUp(self):
+        self.cache = tempfile.TemporaryDirectory()
+        self.previous_cache = os.environ.get('RECOMMENDER_CACHE_DIR')
+        os.environ['RECOMMENDER_CACHE_DIR'] = self.cache.name
+        
+    def tearDown(self):
+        if self.previous_cache is None:
+            os.environ.pop('RECOMMENDER_CACHE_DIR')
+        else:
+            os.environ['RECOMMENDER_CACHE_DIR'] = self.previous_cache
+        self.cache.cleanup()
+        
+    def totals(self, database):
+        totals = {}
+        for row in database.tables['status']:
+            key = (row['entity_type'], row['entity_id'])
+            totals[key] = totals.get(key, 0) + row['visitor_count']
+        return totals
+        
+    def test_failed_batch_is_rewritten_by_next_flush(self):
+        database = FlakyDatabase(failing_inserts={3})
+        counters = InteractionCounters(batch_size=1)
+        counters.record('video', 'video-a', count=2)
+        counters.record('video', 'video-b')
+        counters.record('video', 'video-c', 'user-a', count=4)
+        version = data_version('analytics')
+        
+        # One row per insert: video-a and video-b are written, video-c fails, user-a never starts
+        with self.assertRaises(ConnectionError):
+            counters.flush(database)
+        self.assertEqual(self.totals(database), {('video', 'video-a'): 2, ('video', 'video-b'): 1})
+        self.assertEqual(counters.pending(), {'entities': 1, 'users': 1})
+        self.assertNotEqual(data_version('analytics'), version)
+        
+        counters.record('video', 'video-c')
+        self.assertEqual(counters.flush(database), 2)
+        self.assertEqual(self.totals(database), {
+            ('video', 'video-a'): 2, ('video', 'video-b'): 1, ('video', 'video-c'): 5, ('user', 'user-a'): 4
+        })
+        self.assertEqual(counters.pending(), {'entities': 0, 'users': 0})
+        self.assertEqual(counters.flush(database), 0)
+        
+class TestSuggestionCompaction(unittest.TestCase):
+    def setUp(self):
+        now = datetime.now()
+        self.database = StubDatabase({
+            'suggestion_runs': [
+                {'run_id': 'run-old', 'status': 'published', 'started_at': (now - timedelta(hours=13)).isoformat(),
+                 'completed_at': (now - timedelta(hours=12)).isoformat()},
+                {'run_id': 'run-a', 'status': 'published', 'started_at': (now - timedelta(hours=2)).isoformat(),
+                 'completed_at': (now - timedelta(hours=1)).isoformat()},
+                {'run_id': 'run-b', 'status': 'running', 'started_at': now.isoformat()}
+            ],
+            'suggestions': [
+                {'id': f'{run_id}-{i}', 'run_id': run_id, 'expires_at': (now + timedelta(days=7)).isoformat()}
+                for run_id in ['run-old', 'run-a', 'run-b', None] for i in range(3)
+            ] + [{'id': 'expired', 'run_id': 'run-a', 'expires_at': (now - timedelta(days=1)).isoformat()}]
+        })
+        
+    def remaining(self, run_id):
+        return len([row for row in self.database.tables['suggestions'] if row['run_id'] == run_id])
+        
+    def test_removes_expired_superseded_and_untagged_rows(self):
+        report = SuggestionCompactor(self.database, batch_size=2, batches_per_second=1000).compact()
+        self.assertEqual(report['expired_removed'], 1)
+        self.assertEqual(report['superseded_removed'], 6)
+        self.assertEqual([self.remaining(run_id) for run_id in ['run-old', 'run-a', 'run-b', None]], [0, 3, 3, 0])
+        self.assertEqual(published_run_id(self.database), 'run-a')
+        
+    def test_run_published_during_compaction_stays_visible(self):
+        compactor = SuggestionCompactor(self.database, batch_size=2, batches_per_second=1000)
+        delete_in_batches = compactor.delete_in_batches
+        
+        def publish_run_b(condition):
+            # run-b finishes while the expired rows are being deleted
+            self.database.table('suggestion_runs').update({
+                'status': 'published', 'completed_at': datetime.now().isoformat()
+            }).eq('run_id', 'run-b').execute()
+            compactor.delete_in_batches = delete_in_batches
+            return delete_in_batches(condition)
+            
+        compactor.delete_in_batches = publish_run_b
+        compactor.compact()
+        statuses = {run['run_id']: run['status'] for run in self.database.tables['suggestion_runs']}
+        self.assertEqual(statuses, {'run-old': 'superseded', 'run-a': 'published', 'run-b': 'published'})
+        self.assertEqual(self.remaining('run-b'), 3)
+        self.assertEqual(published_run_id(self.database), 'run-b')
+        
+class TestTextFeatures(unittest.TestCase):
+    # Patched scores between unchanged entities keep their old idf weights
+    IDF_DRIFT_TOLERANCE = 0.01
+    
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+        self.words = [f"term{i}" for i in range(200)]
+        self.entities = [self.entity(i) for i in range(400)]
+        
+    def entity(self, i):
+        return {
+            'id': f'video-{i}',
+            'title': ' '.join(self.rng.choice(self.words, 3)),
+            'description': ' '.join(self.rng.choice(self.words, 8))
+        }
+        
+    def test_full_build_matches_tfidf_vectorizer(self):
+        from sklearn.feature_extraction.text import TfidfVectorizer
+        from sklearn.metrics.pairwise import cosine_similarity
+        index = TextFeatureIndex('videos')
+        self.assertTrue(index.update(self.entities))
+        expected = cosine_similarity(TfidfVectorizer().fit_transform(
+            [f"{entity['title']} {entity['description']}" for entity in self.entities]
+        ))
+        np.fill_diagonal(expected, 0)
+        expected[expected <= SIMILARITY_THRESHOLD] = 0
+        np.testing.assert_allclose(index.similarity.toarray(), expected, atol=1e-5)
+        self.assertFalse(index.update(self.entities))
+        
+    def test_patch_matches_full_rebuild(self):
+        index = TextFeatureIndex('videos')
+        index.update(self.entities)
+        # Two deleted, two new and two edited entities, well under REBUILD_FRACTION
+        changed = [dict(entity) for entity in self.entities[2:]] + [self.entity(400), self.entity(401)]
+        changed[5]['description'] = 'term1 term2 term3 term4 term5'
+        changed[9]['title'] = 'term7 term8'
+        index.update(changed)
+        rebuilt = TextFeatureIndex('videos')
+        rebuilt.update(changed)
+        
+        self.assertEqual(index.ids, rebuilt.ids)
+        self.assertNotIn('video-0', index)
+        patched, expected = index.similarity.toarray(), rebuilt.similarity.toarray()
+        dirty = [index.positions[entity['id']] for entity in [changed[5], changed[9], changed[-2], changed[-1]]]
+        np.testing.assert_allclose(patched[dirty], expected[dirty], atol=1e-6)
+        np.testing.assert_allclose(patched[:, dirty], expected[:, dirty], atol=1e-6)
+        self.assertLessEqual(np.abs(patched - expected)[(patched > 0) & (expected > 0)].max(), self.IDF_DRIFT_TOLERANCE)
+        # Pairs kept by only one of them sit right at the threshold
+        crossed = (patched > 0) != (expected > 0)
+        self.assertLessEqual(np.abs(np.maximum(patched, expected)[crossed] - SIMILARITY_THRESHOLD).max(initial=0),
+                             self.IDF_DRIFT_TOLERANCE)
+        
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,182 @@
+import hashlib
+import os
+import numpy as np
+from scipy import sparse
+from service_state import cache_path
+
+# Stateless hashing keeps the feature space fixed, so new or edited entities can be
+# vectorized without refitting a vocabulary over the whole catalogue
+FEATURE_COUNT = 2 ** 18
+SIMILARITY_THRESHOLD = 0.2
+# Above this share of changed rows a full recompute is cheaper than patching, and it
+# also refreshes pairs whose scores drifted as document frequencies changed
+REBUILD_FRACTION = 0.2
+CHUNK_SIZE = 1024
+
+class TextFeatureIndex:
+    def __init__(self, entity_type):
+        self.entity_type = entity_type
+        self.ids = []
+        self.positions = {}
+        self.digests = np.array([], dtype='S20')
+        self.counts = sparse.csr_matrix((0, FEATURE_COUNT), dtype=np.float32)
+        self.document_frequency = np.zeros(FEATURE_COUNT, dtype=np.int64)
+        self.similarity = sparse.csr_matrix((0, 0), dtype=np.float32)
+
+    @property
+    def path(self):
+        return cache_path('text', f"{self.entity_type}.npz")
+
+    @classmethod
+    def load(cls, entity_type):
+        index = cls(entity_type)
+        if not os.path.exists(index.path):
+            return index
+
+        with np.load(index.path, allow_pickle=False) as stored:
+            if int(stored['feature_count']) != FEATURE_COUNT:
+                return index
+            index.ids = stored['ids'].tolist()
+            index.positions = {entity_id: position for position, entity_id in enumerate(index.ids)}
+            index.digests = stored['digests']
+            index.counts = sparse.csr_matrix(
+                (stored['counts_data'], stored['counts_indices'], stored['counts_indptr']),
+                shape=(len(index.ids), FEATURE_COUNT)
+            )
+            index.document_frequency = stored['document_frequency']
+            index.similarity = sparse.csr_matrix(
+                (stored['similarity_data'], stored['similarity_indices'], stored['similarity_indptr']),
+                shape=(len(index.ids), len(index.ids))
+            )
+        return index
+
+    def save(self):
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, 'wb') as stored:
+            np.savez(
+                stored,
+                feature_count=FEATURE_COUNT,
+                ids=np.array(self.ids, dtype=str),
+                digests=self.digests,
+                counts_data=self.counts.data,
+                counts_indices=self.counts.indices,
+                counts_indptr=self.counts.indptr,
+                document_frequency=self.document_frequency,
+                similarity_data=self.similarity.data,
+                similarity_indices=self.similarity.indices,
+                similarity_indptr=self.similarity.indptr
+            )
+        os.replace(temporary_path, self.path)
+
+    def update(self, entities):
+        texts = {}
+        for entity in entities:
+            title = entity.get('title') or ''
+            description = entity.get('description') or ''
+            if title or description:
+                texts[entity['id']] = f"{title} {description}".strip()
+
+        ids = list(texts)
+        digests = np.array([hashlib.sha1(texts[entity_id].encode('utf-8')).digest() for entity_id in ids], dtype='S20')
+        previous = np.array([self.positions.get(entity_id, -1) for entity_id in ids], dtype=np.int64)
+        unchanged = previous >= 0
+        unchanged[unchanged] = self.digests[previous[unchanged]] == digests[unchanged]
+        dirty = np.flatnonzero(~unchanged)
+
+        if len(dirty) == 0 and len(ids) == len(self.ids):
+            return False
+
+        if not ids:
+            self.__init__(self.entity_type)
+            return True
+
+        # Reuse stored term counts for unchanged rows and hash only the new or edited ones
+        rows = []
+        if unchanged.any():
+            rows.append((np.flatnonzero(unchanged), self.counts[previous[unchanged]]))
+        if len(dirty):
+            rows.append((dirty, self._vectorize([texts[ids[position]] for position in dirty])))
+        counts = _stack_rows(rows, len(ids))
+
+        self.document_frequency = np.bincount(counts.indices, minlength=FEATURE_COUNT).astype(np.int64)
+
+        if len(dirty) > REBUILD_FRACTION * len(ids) or not unchanged.any():
+            similarity = self._similarity_rows(counts, np.arange(len(ids)))
+        else:
+            similarity = self._patch_similarity(counts, previous, unchanged, dirty)
+
+        self.ids = ids
+        self.positions = {entity_id: position for position, entity_id in enumerate(ids)}
+        self.digests = digests
+        self.counts = counts
+        self.similarity = similarity
+        return True
+
+    def similar_to(self, entity_id, max_suggestions=5):
+        position = self.positions.get(entity_id)
+        if position is None:
+            return []
+
+        row = self.similarity.getrow(position)
+        best = np.argsort(-row.data, kind='stable')[:max_suggestions]
+        return [(self.ids[column], float(score)) for column, score in zip(row.indices[best], row.data[best])]
+
+    def __contains__(self, entity_id):
+        return entity_id in self.positions
+
+    def _vectorize(self, texts):
+        from sklearn.feature_extraction.text import HashingVectorizer
+        vectorizer = HashingVectorizer(n_features=FEATURE_COUNT, alternate_sign=False, norm=None)
+        return vectorizer.transform(texts).astype(np.float32).tocsr()
+
+    def _weighted(self, counts):
+        # Same smoothed idf and l2 normalisation as TfidfVectorizer
+        document_count = counts.shape[0]
+        idf = np.log((1 + document_count) / (1 + self.document_frequency)) + 1
+        weighted = (counts @ sparse.diags(idf.astype(np.float32))).tocsr()
+        norms = np.sqrt(np.asarray(weighted.multiply(weighted).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        return sparse.diags(1 / norms).dot(weighted).tocsr().astype(np.float32)
+
+    def _similarity_rows(self, counts, positions):
+        weighted = self._weighted(counts)
+        blocks = []
+        for start in range(0, len(positions), CHUNK_SIZE):
+            chunk = positions[start:start + CHUNK_SIZE]
+            scores = (weighted[chunk] @ weighted.T).tocoo()
+            keep = (scores.data > SIMILARITY_THRESHOLD) & (chunk[scores.row] != scores.col)
+            blocks.append((chunk[scores.row[keep]], scores.col[keep], scores.data[keep]))
+        return _from_entries(blocks, counts.shape[0])
+
+    def _patch_similarity(self, counts, previous, unchanged, dirty):
+        # Keep stored scores between unchanged entities, recompute every pair touching
+        # a new or edited entity and mirror those scores into the unchanged rows
+        clean = np.flatnonzero(unchanged)
+        remap = np.full(len(self.ids), -1, dtype=np.int64)
+        remap[previous[clean]] = clean
+
+        stored = self.similarity.tocoo()
+        row = remap[stored.row]
+        column = remap[stored.col]
+        keep = (row >= 0) & (column >= 0)
+
+        fresh = self._similarity_rows(counts, dirty).tocoo()
+        mirrored = unchanged[fresh.col]
+        return _from_entries([
+            (row[keep], column[keep], stored.data[keep]),
+            (fresh.row, fresh.col, fresh.data),
+            (fresh.col[mirrored], fresh.row[mirrored], fresh.data[mirrored])
+        ], counts.shape[0])
+
+def _stack_rows(rows, total_rows):
+    ordered = np.concatenate([positions for positions, _ in rows])
+    matrix = sparse.vstack([block for _, block in rows]).tocsr()
+    order = np.empty(total_rows, dtype=np.int64)
+    order[ordered] = np.arange(total_rows)
+    return matrix[order]
+
+def _from_entries(blocks, size):
+    rows = np.concatenate([block[0] for block in blocks]) if blocks else np.array([], dtype=np.int64)
+    columns = np.concatenate([block[1] for block in blocks]) if blocks else np.array([], dtype=np.int64)
+    data = np.concatenate([block[2] for block in blocks]) if blocks else np.array([], dtype=np.float32)
+    return sparse.csr_matrix((data.astype(np.float32), (rows, columns)), shape=(size, size))